@@ -1,5 +1,6 @@
 import os
-from supabase import create_client, Client
+import httpx
+from supabase import create_client, Client, ClientOptions
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -11,8 +12,25 @@ supabase_key = os.getenv("SUPABASE_KEY")
 if not supabase_url or not supabase_key:
     raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in .env file")
 
-supabase: Client = create_client(supabase_url, supabase_key)
+# Shared HTTP client so keep-alive connections (and their TLS handshakes) are reused across queries
+http_client = httpx.Client(
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=30),
+    timeout=httpx.Timeout(120),
+    follow_redirects=True,
+    http2=True,
+)
+
+supabase: Client = create_client(
+    supabase_url,
+    supabase_key,
+    options=ClientOptions(httpx_client=http_client),
+)
 
 def get_supabase_client() -> Client:
-    """Returns the Supabase client instance."""
+    """
+    Returns the Supabase client instance.
+    The client is created once at import and shared by every caller, so all
+    requests reuse the same pooled http_client connections - callers should
+    not build their own clients.
+    """
     return supabase
@@ -1,322 +1,774 @@
 # backend/llm_service.py
 
+import asyncio
+import copy
+import logging
 import os
-import json
-from typing import List, Dict, Any
+import httpx
+import orjson
+from functools import lru_cache
+from typing import List, Dict, Any, Iterable, Iterator, Optional
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, NotFoundError
 from dotenv import load_dotenv
 
 from database import get_supabase_client
+from utils.cache import TTLCache, make_cache_key
+from utils.singleflight import SingleFlight
 
 # Load env vars from project root
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '.env'))
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Explicit keep-alive pools with HTTP/2, so concurrent calls multiplex over
+# already-open connections instead of each paying for a new TLS handshake
+OPENAI_POOL_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60)
+OPENAI_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+# Sync client for the streamed plan, which is consumed from a worker thread
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.Client(http2=True, limits=OPENAI_POOL_LIMITS, timeout=OPENAI_TIMEOUT),
+)
+# Async client for everything called from the event loop
+aclient = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(http2=True, limits=OPENAI_POOL_LIMITS, timeout=OPENAI_TIMEOUT),
+)
 supabase = get_supabase_client()
+logger = logging.getLogger(__name__)
+
+# Cache of successful LLM answers keyed on the normalized request. Kept short, skipped
+# for plans requested with `regenerate` (so a new plan is a fresh temperature 1.0 answer),
+# and cleared when the catalog changes (invalidate_llm_cache)
+LLM_CACHE_TTL = 5 * 60
+llm_cache = TTLCache(maxsize=1024, ttl=LLM_CACHE_TTL)
+# Identical plan requests that arrive while one is still running share its LLM call
+plan_flights = SingleFlight()
+# Same for replacement suggestions (e.g. one unsafe meal repeated across a plan)
+replacement_flights = SingleFlight()
+
+
+# Safety verdicts are a plain safe/unsafe classification, so they go to a smaller, faster model
+SAFETY_MODEL = os.getenv("OPENAI_SAFETY_MODEL", "gpt-4.1-nano")
+# Output token budget per exercise in the verdict JSON (name + "safe"/"unsafe")
+SAFETY_TOKENS_PER_EXERCISE = 24
+
+
+# ---------- STRUCTURED OUTPUT SCHEMAS ---------- #
+# Passed as response_format so the API guarantees schema-valid JSON
+# (no code fences or prose around it).
+
+MEAL_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "calories": {"type": "integer"},
+        "protein": {"type": "integer"},
+        "carbs": {"type": "integer"},
+        "fat": {"type": "integer"},
+    },
+    "required": ["name", "calories", "protein", "carbs", "fat"],
+    "additionalProperties": False,
+}
+
+WORKOUT_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "duration": {"type": "string"},
+        "estimated_calories": {"type": "integer"},
+    },
+    "required": ["name", "duration", "estimated_calories"],
+    "additionalProperties": False,
+}
+
+# Item counts are enforced here rather than spelled out in the prompt.
+# Strict mode has no uniqueItems, so duplicate names are still dropped
+# by _normalize_plan / the streaming seen-sets.
+PLAN_MIN_ITEMS = 4
+PLAN_MAX_ITEMS = 6
+
+PLAN_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "meals": {
+            "type": "array",
+            "items": MEAL_SCHEMA,
+            "minItems": PLAN_MIN_ITEMS,
+            "maxItems": PLAN_MAX_ITEMS,
+        },
+        "workouts": {
+            "type": "array",
+            "items": WORKOUT_SCHEMA,
+            "minItems": PLAN_MIN_ITEMS,
+            "maxItems": PLAN_MAX_ITEMS,
+        },
+    },
+    "required": ["meals", "workouts"],
+    "additionalProperties": False,
+}
+
+
+def _json_schema_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    """Build a strict json_schema response_format."""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "schema": schema, "strict": True},
+    }
+
+
+PLAN_RESPONSE_FORMAT = _json_schema_format("plan", PLAN_SCHEMA)
+MEAL_RESPONSE_FORMAT = _json_schema_format("meal", MEAL_SCHEMA)
+WORKOUT_RESPONSE_FORMAT = _json_schema_format("workout", WORKOUT_SCHEMA)
+
+
+def _normalize_text(value: Any) -> str:
+    """Lowercase and collapse whitespace so trivially different inputs share a cache entry."""
+    return " ".join(str(value or "").lower().split())
+
+
+def _llm_cache_key(
+    kind: str,
+    goal: Optional[str] = None,
+    allergies: Optional[List[str]] = None,
+    injuries: Optional[List[Dict[str, str]]] = None,
+    item: Optional[str] = None,
+) -> str:
+    """
+    Canonical cache key for an LLM call: order-insensitive allergies/injuries,
+    case- and whitespace-insensitive text.
+    """
+    return make_cache_key(
+        kind,
+        _normalize_text(goal),
+        sorted(_normalize_text(a) for a in allergies or []),
+        sorted(
+            (_normalize_text(i.get("name")), _normalize_text(i.get("severity", "moderate")))
+            for i in injuries or []
+        ),
+        _normalize_text(item),
+    )
 
 
 def _safe_json_from_model_content(content: str) -> Dict[str, Any]:
     """
-    Strip code fences if present and parse JSON safely.
+    Strip code fences (or other text) around the JSON object and parse it.
+    Responses requested with a json_schema response_format are already clean
+    JSON and go straight to orjson.loads; this only guards older/mocked output.
     """
-    text = content.strip()
+    # Slice from the first "{" to the last "}" - drops fences and any prose around them
+    start = content.find("{")
+    end = content.rfind("}")
+    if start == -1 or end < start:
+        return orjson.loads(content)
+
+    return orjson.loads(content[start:end + 1])
+
 
-    # Remove ``` blocks if the model added them
-    if text.startswith("```"):
-        parts = text.split("```")
-        # Find the part that looks like JSON
-        for part in parts:
-            if "{" in part and "}" in part:
-                text = part.strip()
-                break
+# Active food/exercise names change rarely, so share them across requests for 5 minutes
+catalog_cache = TTLCache(maxsize=1, ttl=300)
+CATALOG_CACHE_KEY = "available_foods_and_exercises"
 
-    return json.loads(text)
 
+def invalidate_available_items_cache() -> None:
+    """Drop the cached food/exercise names so the next plan re-reads Supabase."""
+    catalog_cache.clear()
 
-def get_available_foods_and_exercises() -> tuple[List[str], List[str]]:
+
+def invalidate_llm_cache() -> None:
+    """Drop cached LLM answers, e.g. plans built from foods that were since deactivated."""
+    llm_cache.clear()
+
+
+def _fetch_active_catalog() -> tuple[List[str], List[str]]:
+    """
+    Read active food and exercise names in one round trip through the
+    active_catalog() Postgres function (see README). Falls back to two
+    name-only table queries if the function hasn't been created.
+    """
+    try:
+        catalog = supabase.rpc("active_catalog").execute().data
+        if isinstance(catalog, dict):
+            return list(catalog.get("foods") or []), list(catalog.get("exercises") or [])
+        logger.warning("Unexpected active_catalog() result: %r", catalog)
+    except Exception as e:
+        logger.warning("active_catalog() RPC failed, querying tables instead: %s", e)
+
+    foods_response = (
+        supabase.table("food_items")
+        .select("name")
+        .eq("is_active", True)
+        .execute()
+    )
+    exercises_response = (
+        supabase.table("exercise_items")
+        .select("name")
+        .eq("is_active", True)
+        .execute()
+    )
+    return (
+        [f["name"] for f in foods_response.data or []],
+        [e["name"] for e in exercises_response.data or []],
+    )
+
+
+def get_available_foods_and_exercises() -> tuple[tuple[str, ...], tuple[str, ...]]:
     """
     Fetch available foods and exercises from Supabase to bias the LLM
     toward items we actually support in the database.
+    Results are cached for a few minutes; fallbacks are never cached.
     """
-    foods: List[str] = []
-    exercises: List[str] = []
+    cached = catalog_cache.get(CATALOG_CACHE_KEY)
+    if cached is not None:
+        return cached
+
+    foods: tuple[str, ...] = ()
+    exercises: tuple[str, ...] = ()
 
     try:
-        foods_response = (
-            supabase.table("food_items")
-            .select("name")
-            .eq("is_active", True)
-            .execute()
-        )
-        exercises_response = (
-            supabase.table("exercise_items")
-            .select("name")
-            .eq("is_active", True)
-            .execute()
-        )
+        food_names, exercise_names = _fetch_active_catalog()
 
-        if foods_response.data:
-            foods = [f["name"] for f in foods_response.data]
+        # Sorted so the prompt prefix built from them is identical on every call
+        foods = tuple(sorted(food_names))
+        exercises = tuple(sorted(exercise_names))
 
-        if exercises_response.data:
-            exercises = [e["name"] for e in exercises_response.data]
+        if foods and exercises:
+            catalog_cache.set(CATALOG_CACHE_KEY, (foods, exercises))
 
-    except Exception as e:
-        print(f"Error fetching available items from Supabase: {e}")
+    except Exception:
+        logger.exception("Error fetching available items from Supabase")
 
     # Fallbacks if DB is empty or unavailable
     if not foods:
-        foods = ["Chicken Breast", "Salmon", "Tofu", "Brown Rice", "Quinoa", "Broccoli"]
+        foods = ("Chicken Breast", "Salmon", "Tofu", "Brown Rice", "Quinoa", "Broccoli")
 
     if not exercises:
-        exercises = ["Squats", "Push-Ups", "Stationary Bike", "Planks", "Seated Row"]
+        exercises = ("Squats", "Push-Ups", "Stationary Bike", "Planks", "Seated Row")
 
     return foods, exercises
 
 
-def generate_plan_from_llm(
-    goal: str, allergies: List[str], injuries: List[Dict[str, str]]
-) -> Dict[str, Any]:
+def _fill_meal_defaults(meal: Dict[str, Any]) -> Dict[str, Any]:
+    """Ensure a meal has nutritional info."""
+    meal.setdefault("calories", 0)
+    meal.setdefault("protein", 0)
+    meal.setdefault("carbs", 0)
+    meal.setdefault("fat", 0)
+    return meal
+
+
+def _fill_workout_defaults(workout: Dict[str, Any]) -> Dict[str, Any]:
+    """Ensure a workout has the required fields."""
+    workout.setdefault("duration", "30 minutes")
+    workout.setdefault("estimated_calories", 200)
+    return workout
+
+
+def _iter_plan_items(fragments: Iterable[str]) -> Iterator[tuple[str, Dict[str, Any]]]:
     """
-    Generates a personalized workout + diet plan using OpenAI.
-    Uses:
-      - user goal
-      - allergies
-      - injuries with severities
-      - available foods/exercises from Supabase
+    Incrementally pull completed meal/workout objects out of a streamed JSON plan.
+    Tracks brace depth (ignoring braces inside strings) and yields
+    (section_key, item) as soon as each object inside a top-level array closes.
     """
+    depth = 0
+    in_string = False
+    escaped = False
+    section: Optional[str] = None
+    key_chars: List[str] = []
+    item_chars: List[str] = []
+
+    for fragment in fragments:
+        for ch in fragment:
+            if depth >= 2:
+                item_chars.append(ch)
+
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+                    # Strings directly inside the top-level object are the section keys
+                    if depth == 1:
+                        section = "".join(key_chars)
+                elif depth == 1:
+                    key_chars.append(ch)
+                continue
+
+            if ch == '"':
+                in_string = True
+                key_chars = []
+            elif ch == "{":
+                depth += 1
+                if depth == 2:
+                    item_chars = ["{"]
+            elif ch == "}":
+                depth -= 1
+                if depth == 1 and item_chars:
+                    try:
+                        item = orjson.loads("".join(item_chars))
+                    except orjson.JSONDecodeError as e:
+                        logger.warning("Skipping malformed streamed item: %s", e)
+                    else:
+                        if section and isinstance(item, dict):
+                            yield section, item
+                    item_chars = []
+
+
+# Plan prompt templates, built once at import; item counts are filled in here
+_PLAN_SYSTEM_TEMPLATE = (
+    "You are a fitness and nutrition assistant. Create a one-day plan for the user's goal.\n"
+    "Foods to prefer: {foods_list}\n"
+    "Exercises to prefer: {exercises_list}\n"
+    "\n"
+    f"Return JSON matching the provided schema. {PLAN_MIN_ITEMS}-{PLAN_MAX_ITEMS} unique meals; "
+    f"{PLAN_MIN_ITEMS}-{PLAN_MAX_ITEMS} unique exercises mixing cardio+strength+core.\n"
+    "Never include foods that conflict with the allergies or exercises unsafe for the injuries.\n"
+    "Use realistic per-serving calories and macros (grams)."
+)
+_PLAN_USER_TEMPLATE = (
+    'Goal: "{goal}"\n'
+    "Allergies: {allergy_text}.\n"
+    "Injuries (severity): {injury_text}."
+)
+
+
+@lru_cache(maxsize=4)
+def _plan_system_prompt(foods: tuple[str, ...], exercises: tuple[str, ...]) -> str:
+    """Render the system prompt once per catalog (the catalog itself is cached)."""
+    return _PLAN_SYSTEM_TEMPLATE.format(
+        foods_list=", ".join(foods), exercises_list=", ".join(exercises)
+    )
 
+
+def _build_plan_messages(
+    goal: str, allergies: List[str], injuries: List[Dict[str, str]]
+) -> List[Dict[str, str]]:
+    """
+    Build the plan-generation chat messages.
+    The system message holds the instructions and the (sorted) food/exercise
+    catalog, so it is byte-identical across users and OpenAI's automatic
+    prompt caching can reuse it; only the short user message varies.
+    """
     available_foods, available_exercises = get_available_foods_and_exercises()
 
     allergy_text = ", ".join(allergies) if allergies else "none"
-    injury_descriptions = [
+    injury_text = ", ".join(
         f"{i.get('name', '')} ({i.get('severity', 'moderate')})" for i in injuries
+    ) if injuries else "none"
+
+    return [
+        {"role": "system", "content": _plan_system_prompt(tuple(available_foods), tuple(available_exercises))},
+        {"role": "user", "content": _PLAN_USER_TEMPLATE.format(
+            goal=goal, allergy_text=allergy_text, injury_text=injury_text
+        )},
     ]
-    injury_text = ", ".join(injury_descriptions) if injuries else "none"
 
-    foods_list = ", ".join(available_foods)
-    exercises_list = ", ".join(available_exercises)
 
-    prompt = f"""
-You are an AI fitness and nutrition assistant.
-
-Respond ONLY with valid JSON — no Markdown, no code fences, no explanations.
-
-Create a one-day workout and diet plan for a user whose goal is: "{goal}".
-
-- User allergies: {allergy_text}.
-- User injuries and severities: {injury_text}.
-
-IMPORTANT:
-- Try to primarily use foods from this list: {foods_list}
-- Try to primarily use exercises from this list: {exercises_list}
-- Avoid any foods that conflict with the allergies.
-- Avoid any exercises that would be unsafe given the injuries and severities.
-
-CRITICAL WORKOUT REQUIREMENTS - READ CAREFULLY:
-- Generate anywhere from 3 to 6 workouts
-- ABSOLUTE RULE: NO TWO WORKOUTS CAN HAVE THE SAME NAME
-- Each workout MUST target a DIFFERENT muscle group or movement pattern
-- Mix workout types: at least 1 cardio, at least 1 strength, at least 1 core/flexibility
-- Examples of DIFFERENT workouts: Push-Ups, Squats, Stationary Bike, Plank, Lunges, Rowing Machine
-- INVALID example (DO NOT DO THIS): Dumbbell Shoulder Press, Dumbbell Shoulder Press, Dumbbell Shoulder Press
-- If you're about to repeat a workout, STOP and choose a completely different exercise instead
-
-CRITICAL MEAL REQUIREMENTS:
-- Generate anywhere from 3 to 6 meals
-- ABSOLUTE RULE: NO TWO MEALS CAN HAVE THE SAME NAME
-- Vary the meals: breakfast items, lunch items, dinner items, snacks
-- INVALID example (DO NOT DO THIS): Chicken Breast, Chicken Breast, Chicken Breast
-
-Return JSON with this exact structure:
-
-{{
-  "meals": [
-    {{ 
-      "name": "Scrambled Eggs with Spinach", 
-      "calories": 250,
-      "protein": 18,
-      "carbs": 5,
-      "fat": 15
-    }},
-    {{ 
-      "name": "Grilled Chicken Salad", 
-      "calories": 350,
-      "protein": 35,
-      "carbs": 20,
-      "fat": 12
-    }},
-    {{ 
-      "name": "Quinoa Bowl with Vegetables", 
-      "calories": 300,
-      "protein": 12,
-      "carbs": 45,
-      "fat": 8
-    }},
-    {{ 
-      "name": "Greek Yogurt with Berries", 
-      "calories": 150,
-      "protein": 15,
-      "carbs": 20,
-      "fat": 2
-    }}
-  ],
-  "workouts": [
-    {{ 
-      "name": "Push-Ups", 
-      "duration": "3 sets of 12",
-      "estimated_calories": 100
-    }},
-    {{ 
-      "name": "Squats", 
-      "duration": "3 sets of 15",
-      "estimated_calories": 120
-    }},
-    {{ 
-      "name": "Stationary Bike", 
-      "duration": "20 minutes",
-      "estimated_calories": 200
-    }},
-    {{ 
-      "name": "Plank", 
-      "duration": "3 sets of 45 seconds",
-      "estimated_calories": 75
-    }}
-  ]
-}}
+def _dedupe_by_name(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Drop unnamed items and case-insensitive duplicates in one dict pass,
+    keeping the first occurrence of each name in its original order.
+    """
+    first_by_name: Dict[str, Dict[str, Any]] = {}
+    for item in items:
+        first_by_name.setdefault(item.get("name", "").lower(), item)
+    first_by_name.pop("", None)
+    return list(first_by_name.values())
+
 
-VERIFICATION BEFORE RESPONDING:
-- Count your workouts - do any have the exact same name? If YES, fix it!
-- Count your meals - do any have the exact same name? If YES, fix it!
-- Are you mixing cardio and strength? If NO, add variety!
+def _normalize_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Normalize a parsed plan: field names, duplicate removal and default values.
+    """
+    # Normalize field names
+    if "exercises" in plan and "workouts" not in plan:
+        plan["workouts"] = plan.pop("exercises")
+
+    plan.setdefault("meals", [])
+    plan.setdefault("workouts", [])
+
+    # Remove duplicates (keep first occurrence)
+    original_workout_count = len(plan["workouts"])
+    plan["workouts"] = _dedupe_by_name(plan["workouts"])
+    logger.debug(
+        "Original workout count: %d, After deduplication: %d",
+        original_workout_count, len(plan["workouts"]),
+    )
 
-FINAL REQUIREMENTS:
-- Each meal MUST include: name, calories (integer), protein (grams as integer), carbs (grams as integer), fat (grams as integer)
-- Each workout MUST include: name, duration (string), estimated_calories (integer)
-- Provide realistic nutritional values based on typical serving sizes
-- VERIFY: Every workout name is different from every other workout name
-- VERIFY: Every meal name is different from every other meal name
+    original_meal_count = len(plan["meals"])
+    plan["meals"] = _dedupe_by_name(plan["meals"])
+    logger.debug(
+        "Original meal count: %d, After deduplication: %d",
+        original_meal_count, len(plan["meals"]),
+    )
 
-Return ONLY the JSON.
-"""
+    # Ensure all meals have nutritional info
+    for meal in plan["meals"]:
+        _fill_meal_defaults(meal)
+
+    # Ensure all workouts have required fields
+    for workout in plan["workouts"]:
+        _fill_workout_defaults(workout)
+
+    return plan
+
+
+async def generate_plan_from_llm(
+    goal: str, allergies: List[str], injuries: List[Dict[str, str]], regenerate: bool = False
+) -> Dict[str, Any]:
+    """
+    Generates a personalized workout + diet plan using OpenAI.
+    Uses:
+      - user goal
+      - allergies
+      - injuries with severities
+      - available foods/exercises from Supabase
+    Pass `regenerate` to skip a cached plan and ask the model for a new one.
+    """
+    cache_key = _llm_cache_key("plan", goal=goal, allergies=allergies, injuries=injuries)
+    if not regenerate:
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    # Building the prompt may load the catalog from Supabase (blocking client)
+    messages = await asyncio.to_thread(_build_plan_messages, goal, allergies, injuries)
 
     try:
-        response = client.chat.completions.create(
+        response = await aclient.chat.completions.create(
             model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+            messages=messages,
             temperature=1.0,  # Increased for more variety
+            response_format=PLAN_RESPONSE_FORMAT,
         )
 
         content = response.choices[0].message.content or ""
-        print("Raw LLM plan text:\n", content)
+        logger.debug("Raw LLM plan text:\n%s", content)
 
         plan = _safe_json_from_model_content(content)
 
-        # Normalize field names
-        if "exercises" in plan and "workouts" not in plan:
-            plan["workouts"] = plan.pop("exercises")
-
-        plan.setdefault("meals", [])
-        plan.setdefault("workouts", [])
-
-        # Remove duplicate workouts (keep first occurrence)
-        seen_workout_names = set()
-        unique_workouts = []
-        original_workout_count = len(plan["workouts"])
-        for workout in plan["workouts"]:
-            workout_name = workout.get("name", "").lower()
-            if workout_name and workout_name not in seen_workout_names:
-                seen_workout_names.add(workout_name)
-                unique_workouts.append(workout)
-
-        plan["workouts"] = unique_workouts
-        print(f"Original workout count: {original_workout_count}, After deduplication: {len(unique_workouts)}")
-
-        # Remove duplicate meals (keep first occurrence)
-        seen_meal_names = set()
-        unique_meals = []
-        original_meal_count = len(plan["meals"])
-        for meal in plan["meals"]:
-            meal_name = meal.get("name", "").lower()
-            if meal_name and meal_name not in seen_meal_names:
-                seen_meal_names.add(meal_name)
-                unique_meals.append(meal)
-
-        plan["meals"] = unique_meals
-        print(f"Original meal count: {original_meal_count}, After deduplication: {len(unique_meals)}")
-
-        # Ensure all meals have nutritional info
-        for meal in plan["meals"]:
-            meal.setdefault("calories", 0)
-            meal.setdefault("protein", 0)
-            meal.setdefault("carbs", 0)
-            meal.setdefault("fat", 0)
-
-        # Ensure all workouts have required fields
-        for workout in plan["workouts"]:
-            workout.setdefault("duration", "30 minutes")
-            workout.setdefault("estimated_calories", 200)
-
-        print("Parsed Plan:", json.dumps(plan, indent=2))
+        plan = _normalize_plan(plan)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Parsed Plan: %s", orjson.dumps(plan, option=orjson.OPT_INDENT_2).decode())
+        llm_cache.set(cache_key, plan)
         return plan
 
-    except json.JSONDecodeError as e:
-        print("JSON parsing failed in generate_plan_from_llm:", e)
+    except orjson.JSONDecodeError:
+        logger.exception("JSON parsing failed in generate_plan_from_llm")
         return {"error": "Model did not return valid JSON", "meals": [], "workouts": []}
     except Exception as e:
-        print("LLM generation failed in generate_plan_from_llm:", e)
+        logger.exception("LLM generation failed in generate_plan_from_llm")
         return {"error": f"LLM generation failed: {e}", "meals": [], "workouts": []}
 
 
-def validate_exercise_safety(
-    exercise_name: str, injuries: List[Dict[str, str]], goal: str | None = None
-) -> bool:
+async def generate_plan_coalesced(
+    goal: str, allergies: List[str], injuries: List[Dict[str, str]], regenerate: bool = False
+) -> Dict[str, Any]:
     """
-    Uses the LLM to check if an exercise is safe given the user's injuries.
-    Returns:
+    generate_plan_from_llm for the API: concurrent requests with the same
+    (normalized) goal/allergies/injuries wait on one shared LLM call.
+    Each caller gets its own copy of the plan. With `regenerate` the caller
+    gets its own fresh LLM call instead (the new plan replaces the cached one).
+    """
+    if regenerate:
+        return await generate_plan_from_llm(goal, allergies, injuries, regenerate=True)
+
+    cache_key = _llm_cache_key("plan", goal=goal, allergies=allergies, injuries=injuries)
+    plan = await plan_flights.do(
+        cache_key, lambda: generate_plan_from_llm(goal, allergies, injuries)
+    )
+    return copy.deepcopy(plan)
+
+
+def stream_plan_from_llm(
+    goal: str, allergies: List[str], injuries: List[Dict[str, str]]
+) -> Iterator[tuple[str, Dict[str, Any]]]:
+    """
+    Streaming variant of generate_plan_from_llm.
+    Yields ("meals", meal) / ("workouts", workout) as soon as the model
+    finishes writing each object, with the same dedup and defaults applied.
+    API errors are raised to the caller.
+    """
+    messages = _build_plan_messages(goal, allergies, injuries)
+
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        temperature=1.0,
+        response_format=PLAN_RESPONSE_FORMAT,
+        stream=True,
+    )
+
+    fragments = (
+        chunk.choices[0].delta.content or ""
+        for chunk in response
+        if chunk.choices
+    )
+
+    seen_names: Dict[str, set] = {"meals": set(), "workouts": set()}
+    for section, item in _iter_plan_items(fragments):
+        # Normalize field names
+        if section == "exercises":
+            section = "workouts"
+        if section not in seen_names:
+            continue
+
+        # Skip duplicates (keep first occurrence)
+        item_name = str(item.get("name", "")).lower()
+        if not item_name or item_name in seen_names[section]:
+            continue
+        seen_names[section].add(item_name)
+
+        if section == "meals":
+            yield section, _fill_meal_defaults(item)
+        else:
+            yield section, _fill_workout_defaults(item)
+
+
+# OpenAI allows at most 16 metadata entries per batch: two tag the batch as ours and
+# record the user who queued it, the rest each hold one request's inputs
+MAX_BATCH_METADATA_ENTRIES = 16
+PLAN_BATCH_SOURCE = "plan-batch"
+MAX_BATCH_PLANS = MAX_BATCH_METADATA_ENTRIES - 2
+MAX_BATCH_METADATA_VALUE = 512
+
+
+async def submit_plan_batch(plan_requests: List[Dict[str, Any]], owner: str) -> Dict[str, Any]:
+    """
+    Queue several plan generations on the OpenAI Batch API
+    (completes within 24h at roughly half the real-time token price).
+    Each request is a dict with goal, allergies and normalized injuries;
+    the inputs are kept in the batch metadata so results can be rule-checked later,
+    along with `owner` (the submitting user's id).
+    Raises ValueError if the batch doesn't fit in the metadata limits.
+    """
+    if len(plan_requests) > MAX_BATCH_PLANS:
+        raise ValueError(f"A batch can hold at most {MAX_BATCH_PLANS} plan requests")
+
+    lines: List[bytes] = []
+    metadata: Dict[str, str] = {"source": PLAN_BATCH_SOURCE, "owner": owner}
+
+    for index, request in enumerate(plan_requests):
+        custom_id = f"plan-{index}"
+        request_json = orjson.dumps(request).decode()
+        if len(request_json) > MAX_BATCH_METADATA_VALUE:
+            raise ValueError(f"Plan request {index} is too large to batch")
+        metadata[custom_id] = request_json
+
+        messages = _build_plan_messages(
+            request.get("goal", ""), request.get("allergies", []), request.get("injuries", [])
+        )
+        lines.append(orjson.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o-mini",
+                "messages": messages,
+                "temperature": 1.0,
+                "response_format": PLAN_RESPONSE_FORMAT,
+            },
+        }))
+
+    batch_file = await aclient.files.create(
+        file=("plan_batch.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    batch = await aclient.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata=metadata,
+    )
+    logger.info("Submitted plan batch %s with %d requests", batch.id, len(lines))
+
+    return {"batch_id": batch.id, "status": batch.status}
+
+
+def _batch_plan_index(custom_id: Any) -> Optional[int]:
+    """Position of a `plan-<n>` custom_id in its batch, or None for anything else."""
+    if not isinstance(custom_id, str) or not custom_id.startswith("plan-"):
+        return None
+    index = custom_id[len("plan-"):]
+    return int(index) if index.isdigit() else None
+
+
+async def get_plan_batch_results(batch_id: str, owner: str) -> Optional[Dict[str, Any]]:
+    """
+    Check a plan batch. Once it has completed, download and parse every plan.
+    Returns {"batch_id", "status", "plans": [{"request": {...}, "plan": {...}}, ...]}
+    with plans in submission order; a plan that failed carries an "error" key.
+    Returns None if there is no such batch, submit_plan_batch didn't create it,
+    or it was queued by someone other than `owner`.
+    """
+    try:
+        batch = await aclient.batches.retrieve(batch_id)
+    except NotFoundError:
+        return None
+
+    metadata = batch.metadata or {}
+    if metadata.get("source") != PLAN_BATCH_SOURCE or metadata.get("owner") != owner:
+        return None
+    if batch.status != "completed" or not batch.output_file_id:
+        return {"batch_id": batch.id, "status": batch.status, "plans": []}
+
+    output = await aclient.files.content(batch.output_file_id)
+
+    results: Dict[int, Dict[str, Any]] = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+
+        record = orjson.loads(line)
+        custom_id = record.get("custom_id")
+        index = _batch_plan_index(custom_id)
+        if index is None or custom_id not in metadata:
+            logger.warning("Skipping unexpected custom_id %r in batch %s", custom_id, batch.id)
+            continue
+
+        try:
+            content = record["response"]["body"]["choices"][0]["message"]["content"] or ""
+            plan = _normalize_plan(_safe_json_from_model_content(content))
+        except orjson.JSONDecodeError:
+            plan = {"error": "Model did not return valid JSON", "meals": [], "workouts": []}
+        except (KeyError, IndexError, TypeError):
+            plan = {"error": f"Batch request failed: {record.get('error')}", "meals": [], "workouts": []}
+
+        try:
+            request = orjson.loads(metadata[custom_id])
+        except orjson.JSONDecodeError:
+            request = {}
+
+        results[index] = {"request": request, "plan": plan}
+
+    # Output lines are not guaranteed to be in input order
+    return {
+        "batch_id": batch.id,
+        "status": batch.status,
+        "plans": [results[index] for index in sorted(results)],
+    }
+
+
+async def validate_exercises_batch(
+    exercise_names: List[str], injuries: List[Dict[str, str]], goal: str | None = None
+) -> Dict[str, bool]:
+    """
+    Uses the LLM to check several exercises against the user's injuries in one call.
+    Returns {exercise_name: safe?} where:
       True  -> safe
       False -> unsafe or uncertain
+    Cached verdicts are reused; only the remaining exercises are sent to the model.
     """
+    results: Dict[str, bool] = {}
+    pending_keys: Dict[str, str] = {}
+
+    for name in exercise_names:
+        cache_key = _llm_cache_key("safety", goal=goal, injuries=injuries, item=name)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            results[name] = cached
+        else:
+            pending_keys[name] = cache_key
+
+    if not pending_keys:
+        return results
+
     injury_text = ", ".join(
         f"{i.get('name', '')} ({i.get('severity', 'moderate')})" for i in injuries
     )
 
     goal_text = f" The user's goal is '{goal}'." if goal else ""
 
+    exercise_list = "\n".join(
+        f"{n}. {name}" for n, name in enumerate(pending_keys, start=1)
+    )
+
     prompt = f"""
 You are a certified physical therapist AI.
 
 The user has the following injuries: {injury_text}.{goal_text}
-Determine if the exercise "{exercise_name}" is safe to perform.
+Determine if each of these exercises is safe to perform:
+{exercise_list}
 
-Respond ONLY with one word: "safe" or "unsafe".
+Respond ONLY with a JSON object mapping every exercise name, exactly as written, to "safe" or "unsafe":
+{{"results": {{"Push-Ups": "safe", "Squats": "unsafe"}}}}
 """
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
+        response = await aclient.chat.completions.create(
+            model=SAFETY_MODEL,
             messages=[{"role": "user", "content": prompt}],
             temperature=0,
+            max_tokens=16 + SAFETY_TOKENS_PER_EXERCISE * len(pending_keys),
+            response_format={"type": "json_object"},
         )
 
-        answer = (response.choices[0].message.content or "").strip().lower()
-        print(f"LLM validation for '{exercise_name}': {answer}")
-        return answer.startswith("safe")
+        content = response.choices[0].message.content or ""
+        logger.debug("LLM validation for %d exercises: %s", len(pending_keys), content)
 
-    except Exception as e:
-        print(f"Error validating {exercise_name}:", e)
+        answers = _safe_json_from_model_content(content).get("results") or {}
+        verdicts = {
+            str(name).strip().lower(): str(answer).strip().lower()
+            for name, answer in answers.items()
+        }
+
+        for name, cache_key in pending_keys.items():
+            verdict = verdicts.get(name.strip().lower())
+            if verdict is None:
+                # Model skipped it: treat as unsafe, but ask again next time
+                results[name] = False
+                continue
+
+            is_safe = verdict.startswith("safe")
+            llm_cache.set(cache_key, is_safe)
+            results[name] = is_safe
+
+    except Exception:
+        logger.exception("Error validating %s", list(pending_keys))
         # On errors we act conservatively: treat as unsafe
-        return False
+        for name in pending_keys:
+            results[name] = False
+
+    return results
+
+
+async def validate_exercise_safety(
+    exercise_name: str, injuries: List[Dict[str, str]], goal: str | None = None
+) -> bool:
+    """
+    Uses the LLM to check if an exercise is safe given the user's injuries.
+    Returns:
+      True  -> safe
+      False -> unsafe or uncertain
+    """
+    results = await validate_exercises_batch([exercise_name], injuries, goal)
+    return results[exercise_name]
 
 
-def suggest_food_replacement(
+async def suggest_food_replacement(
     item_name: str, allergen: str, goal: str | None = None
 ) -> Dict[str, Any]:
     """
     Ask the LLM for a safe food replacement.
     Returns a dict like: {"name": "...", "calories": 200, "protein": 20, "carbs": 30, "fat": 10}
     """
+    cache_key = _llm_cache_key("food_replacement", goal=goal, allergies=[allergen], item=item_name)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    replacement = await replacement_flights.do(
+        cache_key, lambda: _request_food_replacement(item_name, allergen, goal, cache_key)
+    )
+    return copy.deepcopy(replacement)
+
+
+async def _request_food_replacement(
+    item_name: str, allergen: str, goal: str | None, cache_key: str
+) -> Dict[str, Any]:
     goal_text = f" The user's overall goal is '{goal}'." if goal else ""
 
     prompt = f"""
@@ -341,24 +793,27 @@ Include realistic nutritional values (protein, carbs, fat in grams).
 """
 
     try:
-        response = client.chat.completions.create(
+        response = await aclient.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.5,
+            response_format=MEAL_RESPONSE_FORMAT,
         )
         content = response.choices[0].message.content or ""
-        print("Raw LLM food replacement text:\n", content)
+        logger.debug("Raw LLM food replacement text:\n%s", content)
         data = _safe_json_from_model_content(content)
         # Basic safety defaults
-        return {
+        replacement = {
             "name": data.get("name", "Generic Safe Meal"),
             "calories": data.get("calories", 300),
             "protein": data.get("protein", 20),
             "carbs": data.get("carbs", 30),
             "fat": data.get("fat", 10),
         }
-    except Exception as e:
-        print("Error in suggest_food_replacement:", e)
+        llm_cache.set(cache_key, replacement)
+        return replacement
+    except Exception:
+        logger.exception("Error in suggest_food_replacement")
         return {
             "name": "Generic Safe Meal", 
             "calories": 300,
@@ -368,13 +823,27 @@ Include realistic nutritional values (protein, carbs, fat in grams).
         }
 
 
-def suggest_exercise_replacement(
+async def suggest_exercise_replacement(
     exercise_name: str, injuries: List[Dict[str, str]], goal: str | None = None
 ) -> Dict[str, Any]:
     """
     Ask the LLM for a safe exercise replacement.
     Returns a dict like: {"name": "...", "duration": "3 sets of 10", "estimated_calories": 150}
     """
+    cache_key = _llm_cache_key("exercise_replacement", goal=goal, injuries=injuries, item=exercise_name)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    replacement = await replacement_flights.do(
+        cache_key, lambda: _request_exercise_replacement(exercise_name, injuries, goal, cache_key)
+    )
+    return copy.deepcopy(replacement)
+
+
+async def _request_exercise_replacement(
+    exercise_name: str, injuries: List[Dict[str, str]], goal: str | None, cache_key: str
+) -> Dict[str, Any]:
     injury_text = ", ".join(
         f"{i.get('name', '')} ({i.get('severity', 'moderate')})" for i in injuries
     )
@@ -401,21 +870,24 @@ Include estimated calories burned.
 """
 
     try:
-        response = client.chat.completions.create(
+        response = await aclient.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": prompt}],
             temperature=0.5,
+            response_format=WORKOUT_RESPONSE_FORMAT,
         )
         content = response.choices[0].message.content or ""
-        print("Raw LLM exercise replacement text:\n", content)
+        logger.debug("Raw LLM exercise replacement text:\n%s", content)
         data = _safe_json_from_model_content(content)
-        return {
+        replacement = {
             "name": data.get("name", "Safe Alternative Exercise"),
             "duration": data.get("duration", "3 sets of 10"),
             "estimated_calories": data.get("estimated_calories", 150),
         }
-    except Exception as e:
-        print("Error in suggest_exercise_replacement:", e)
+        llm_cache.set(cache_key, replacement)
+        return replacement
+    except Exception:
+        logger.exception("Error in suggest_exercise_replacement")
         return {
             "name": "Safe Alternative Exercise", 
             "duration": "3 sets of 10",
@@ -1,41 +1,84 @@
 # backend/main.py - Secure Authentication with Database Storage
-# This version uses bcrypt for password hashing and stores sessions in Supabase
+# This version uses bcrypt for password hashing and HMAC-signed session tokens
 
-from fastapi import FastAPI, HTTPException, Response, Cookie
+from fastapi import FastAPI, HTTPException, Response, Cookie, Header, BackgroundTasks, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Union, Dict, Any, Optional
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.concurrency import iterate_in_threadpool
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, model_validator
+from postgrest.exceptions import APIError
+from typing import List, Dict, Any, Optional, AsyncIterator
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import re
 import secrets
+import time
+import orjson
 import bcrypt
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
-from rules_engine import RulesEngine
-from llm_service import generate_plan_from_llm
+from rules_engine import RulesEngine, invalidate_catalog_rows_cache
+from llm_service import (
+    generate_plan_coalesced,
+    stream_plan_from_llm,
+    submit_plan_batch,
+    get_plan_batch_results,
+    invalidate_available_items_cache,
+    invalidate_llm_cache,
+)
 from database import get_supabase_client
 from utils.images import get_smart_food_image, get_smart_exercise_image
+from utils.cache import TTLCache, make_cache_key
+from utils.log import setup_logging
 
 # ============================================
 # FASTAPI APP SETUP
 # ============================================
 
-app = FastAPI(title="Workout & Diet Planner API")
+setup_logging()
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="Workout & Diet Planner API", default_response_class=ORJSONResponse)
 
 # CORS Configuration
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "http://localhost:5173,http://127.0.0.1:5173").split(",")
+    if origin.strip()
+]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["http://localhost:5173", "http://127.0.0.1:5173"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # browsers reuse a preflight for a day instead of re-sending OPTIONS
 )
 
+# Compress larger JSON bodies (saved plans, generated plans); SSE streams are left alone
+app.add_middleware(GZipMiddleware, minimum_size=500)
+
 # ============================================
 # AUTHENTICATION HELPER FUNCTIONS
 # ============================================
 
+# bcrypt work factor; raise it on hosts where hashing is fast enough
+BCRYPT_ROUNDS = min(max(int(os.getenv("BCRYPT_ROUNDS", "12")), 4), 31)
+logger.info("Password hashing: bcrypt %s, %d rounds", bcrypt.__version__, BCRYPT_ROUNDS)
+
+# Stored instead of a hash for accounts that must never log in (shadow-file "!" convention).
+# Creating such a user costs no bcrypt work, and login rejects it before verify_password.
+LOCKED_PASSWORD_HASH = "!"
+
 def hash_password(password: str) -> str:
     """Hash a password using bcrypt"""
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
@@ -43,71 +86,183 @@ def verify_password(password: str, password_hash: str) -> bool:
     """Verify a password against its hash"""
     return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
 
+# Sessions are HMAC-signed tokens carrying the user id, name and expiry, so
+# checking one is a local SHA-256 plus a (briefly cached) revocation lookup.
+SESSION_LIFETIME = timedelta(days=7)
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+if not SESSION_SECRET:
+    # Every worker, and every restart, has to verify the same signatures
+    raise ValueError("SESSION_SECRET must be set in .env file")
+
+# Logged-out tokens are recorded in the revoked_sessions table, which every worker
+# checks; this process also remembers the ones it knows are revoked
+revoked_sessions = TTLCache(maxsize=100_000, ttl=SESSION_LIFETIME.total_seconds())
+
+# Valid sessions (signed tokens that passed the revocation check, and legacy opaque
+# tokens looked up in the sessions table) are cached briefly, so a logout on another
+# worker takes effect here within SESSION_CACHE_TTL seconds
+SESSION_CACHE_TTL = 30
+session_cache = TTLCache(maxsize=10_000, ttl=SESSION_CACHE_TTL)
+
+# Serialized /api/plans responses per user, tagged with the version of the user's plan
+# list they were built from; a save or delete on any worker changes that version
+PLANS_CACHE_TTL = 60
+plans_cache = TTLCache(maxsize=10_000, ttl=PLANS_CACHE_TTL)
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign_session(payload: str) -> str:
+    digest = hmac.new(SESSION_SECRET.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).digest()
+    return _b64encode(digest)
+
+def _valid_signature(payload: str, signature: str) -> bool:
+    """Constant-time signature check; compared as bytes so a non-ASCII cookie is just invalid"""
+    return hmac.compare_digest(signature.encode("utf-8"), _sign_session(payload).encode("ascii"))
+
 def create_session(user_id: str, username: str) -> str:
-    """Create a new session in Supabase and return session ID"""
-    supabase = get_supabase_client()
-    session_id = secrets.token_urlsafe(32)
-    expires_at = datetime.now() + timedelta(days=7)
-    
-    try:
-        supabase.table('sessions').insert({
-            "session_id": session_id,
-            "user_id": user_id,
-            "expires_at": expires_at.isoformat()
-        }).execute()
-        
-        return session_id
-    except Exception as e:
-        print(f"Error creating session: {e}")
-        raise
+    """Create a signed session token (no database write) and return it"""
+    payload = _b64encode(orjson.dumps({
+        "uid": user_id,
+        "name": username,
+        "exp": int(time.time() + SESSION_LIFETIME.total_seconds()),
+    }))
+    return f"{payload}.{_sign_session(payload)}"
 
 def get_session(session_id: Optional[str]) -> Optional[Dict]:
-    """Get session data from Supabase if valid, None otherwise"""
+    """Get session data from a valid signed token (or a legacy Supabase session), None otherwise"""
     if not session_id:
         return None
     
+    if "." not in session_id:
+        return _get_legacy_session(session_id)
+    
+    payload, _, signature = session_id.partition(".")
+    if not _valid_signature(payload, signature):
+        return None
+    if revoked_sessions.get(session_id):
+        return None
+    
+    try:
+        data = orjson.loads(_b64decode(payload))
+    except (ValueError, binascii.Error):
+        return None
+    
+    if data.get("exp", 0) <= time.time():
+        return None
+    
+    cached = session_cache.get(session_id)
+    if cached is not None:
+        return cached
+    
+    if _is_revoked(signature):
+        revoked_sessions.set(session_id, True)
+        return None
+    
+    session_data = {
+        "user_id": data["uid"],
+        "username": data["name"]
+    }
+    session_cache.set(session_id, session_data)
+    return session_data
+
+def _is_revoked(signature: str) -> bool:
+    """Whether a signed token was logged out on any worker. If the check fails the
+    verified signature alone is trusted, so a database outage doesn't log everyone out."""
     supabase = get_supabase_client()
     
+    try:
+        result = supabase.table('revoked_sessions')\
+            .select('signature')\
+            .eq('signature', signature)\
+            .limit(1)\
+            .execute()
+        return bool(result.data)
+    except Exception:
+        logger.exception("Error checking session revocation")
+        return False
+
+def _get_legacy_session(session_id: str) -> Optional[Dict]:
+    """Look up an opaque session token in Supabase"""
+    cached = session_cache.get(session_id)
+    if cached is not None:
+        return cached
+    
+    supabase = get_supabase_client()
+    
+    # Postgres drops expired rows (and ones expiring before a cache entry would), so
+    # nothing is parsed here; expired rows are purged by a scheduled job (see README)
+    valid_after = datetime.now(timezone.utc) + timedelta(seconds=SESSION_CACHE_TTL)
+    
     try:
         # Get session from database
-        result = supabase.table('sessions').select('*, users(id, name, email)').eq('session_id', session_id).execute()
+        result = supabase.table('sessions')\
+            .select('users(id, name)')\
+            .eq('session_id', session_id)\
+            .gt('expires_at', valid_after.isoformat())\
+            .execute()
         
         if not result.data:
             return None
         
-        session = result.data[0]
-        
-        # Check if expired
-        expires_at = datetime.fromisoformat(session['expires_at'].replace('Z', '+00:00'))
-        if datetime.now(expires_at.tzinfo) > expires_at:
-            # Delete expired session
-            supabase.table('sessions').delete().eq('session_id', session_id).execute()
-            return None
-        
         # Return user data
-        user = session.get('users')
+        user = result.data[0].get('users')
         if user:
-            return {
+            session_data = {
                 "user_id": user['id'],
                 "username": user['name']
             }
+            session_cache.set(session_id, session_data)
+            return session_data
         
         return None
-    except Exception as e:
-        print(f"Error getting session: {e}")
+    except Exception:
+        logger.exception("Error getting session")
         return None
 
+def require_user(session_id: Optional[str] = Cookie(None)) -> str:
+    """Dependency for protected endpoints: the logged-in user's id, or 401"""
+    session_data = get_session(session_id)
+    if not session_data:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return session_data["user_id"]
+
 def delete_session(session_id: str):
-    """Delete a session from Supabase"""
+    """Revoke a signed session token, or delete a legacy session from Supabase"""
     if not session_id:
         return
     
+    session_cache.delete(session_id)
     supabase = get_supabase_client()
     
+    if "." in session_id:
+        payload, _, signature = session_id.partition(".")
+        if not _valid_signature(payload, signature):
+            return
+        revoked_sessions.set(session_id, True)
+        
+        # Kept until the token would have expired anyway (purged by a scheduled job, see README)
+        try:
+            exp = orjson.loads(_b64decode(payload))["exp"]
+        except (ValueError, KeyError, binascii.Error):
+            exp = time.time() + SESSION_LIFETIME.total_seconds()
+        
+        try:
+            supabase.table('revoked_sessions').upsert({
+                'signature': signature,
+                'expires_at': datetime.fromtimestamp(exp, timezone.utc).isoformat()
+            }).execute()
+        except Exception:
+            logger.exception("Error revoking session")
+        return
+    
     try:
         supabase.table('sessions').delete().eq('session_id', session_id).execute()
-    except Exception as e:
-        print(f"Error deleting session: {e}")
+    except Exception:
+        logger.exception("Error deleting session")
 
 # ============================================
 # PYDANTIC MODELS
@@ -124,13 +279,33 @@ class LoginRequest(BaseModel):
 
 # Plan Generation Models
 class Injury(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     name: str
     severity: str = "moderate"
 
+    @model_validator(mode="before")
+    @classmethod
+    def from_name(cls, value: Any) -> Any:
+        """Accept a bare injury name as shorthand for {"name": ..., "severity": "moderate"}"""
+        return {"name": value} if isinstance(value, str) else value
+
 class PlanRequest(BaseModel):
     goal: str
     allergies: List[str] = []
-    injuries: Union[List[str], List[Injury]] = []
+    injuries: List[Injury] = []
+    # Ask for a new plan rather than a recently cached one for the same inputs
+    regenerate: bool = False
+
+    def injury_dicts(self) -> List[Dict[str, str]]:
+        """Injuries in the {name, severity} shape the LLM service and rules engine expect"""
+        return _INJURY_LIST.dump_python(self.injuries)
+
+# Dumps a whole injury list in one pydantic-core call instead of a Python loop
+_INJURY_LIST = TypeAdapter(List[Injury])
+
+class PlanBatchRequest(BaseModel):
+    requests: List[PlanRequest]
 
 # Save Plan Model
 class SavePlanRequest(BaseModel):
@@ -141,6 +316,10 @@ class SavePlanRequest(BaseModel):
     allergies: Optional[List[str]] = None
     injuries: Optional[List[str]] = None
 
+# Image Models
+class ImageBatchRequest(BaseModel):
+    names: List[str] = Field(max_length=100)
+
 # Profile Models
 class UpdateProfileRequest(BaseModel):
     name: Optional[str] = None
@@ -154,30 +333,32 @@ class UpdateProfileRequest(BaseModel):
 # ============================================
 # AUTHENTICATION ENDPOINTS
 # ============================================
+# Endpoints that only make blocking Supabase/bcrypt calls are plain `def`,
+# so FastAPI runs them in its threadpool instead of stalling the event loop.
 
 @app.post("/api/signup")
-async def signup(request: SignupRequest):
+def signup(request: SignupRequest):
     """
     Create a new user account with secure password hashing
     """
     supabase = get_supabase_client()
     
     try:
-        # Check if username already exists
-        existing = supabase.table('users').select('id').eq('email', request.username).execute()
-        
-        if existing.data:
-            raise HTTPException(status_code=409, detail="Username already taken")
-        
         # Hash password with bcrypt
         password_hash = hash_password(request.password)
         
-        # Create user in database
-        result = supabase.table('users').insert({
-            "name": request.username,
-            "email": request.username,  # Using username as email for simplicity
-            "password_hash": password_hash
-        }).execute()
+        # Create user in database; the unique constraint on users.email
+        # rejects taken usernames, so no separate existence check is needed
+        try:
+            result = supabase.table('users').insert({
+                "name": request.username,
+                "email": request.username,  # Using username as email for simplicity
+                "password_hash": password_hash
+            }).execute()
+        except APIError as e:
+            if e.code == "23505":  # unique_violation
+                raise HTTPException(status_code=409, detail="Username already taken")
+            raise
         
         if not result.data:
             raise HTTPException(status_code=500, detail="Failed to create user")
@@ -187,12 +368,12 @@ async def signup(request: SignupRequest):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Signup error: {e}")
+        logger.exception("Signup error")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/api/login")
-async def login(request: LoginRequest, response: Response):
+def login(request: LoginRequest, response: Response):
     """
     Log in with username and password, create session in database
     """
@@ -200,7 +381,7 @@ async def login(request: LoginRequest, response: Response):
     
     try:
         # Find user by username
-        result = supabase.table('users').select('*').eq('email', request.username).execute()
+        result = supabase.table('users').select('id, name, password_hash').eq('email', request.username).execute()
         
         if not result.data:
             raise HTTPException(status_code=401, detail="Invalid credentials")
@@ -208,11 +389,12 @@ async def login(request: LoginRequest, response: Response):
         user = result.data[0]
         
         # Verify password
-        if not user.get('password_hash'):
-            # User has no password (old account), reject login
+        password_hash = user.get('password_hash') or ''
+        if not password_hash or password_hash.startswith(LOCKED_PASSWORD_HASH):
+            # No password (old account) or login disabled, reject without running bcrypt
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
-        if not verify_password(request.password, user['password_hash']):
+        if not verify_password(request.password, password_hash):
             raise HTTPException(status_code=401, detail="Invalid credentials")
         
         # Create session in database
@@ -232,12 +414,12 @@ async def login(request: LoginRequest, response: Response):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Login error: {e}")
+        logger.exception("Login error")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/api/logout")
-async def logout(response: Response, session_id: Optional[str] = Cookie(None)):
+def logout(response: Response, session_id: Optional[str] = Cookie(None)):
     """
     Log out and delete session from database
     """
@@ -249,7 +431,7 @@ async def logout(response: Response, session_id: Optional[str] = Cookie(None)):
 
 
 @app.get("/api/me")
-async def get_current_user(session_id: Optional[str] = Cookie(None)):
+def get_current_user(session_id: Optional[str] = Cookie(None)):
     """
     Get current logged-in user from database session
     """
@@ -275,7 +457,7 @@ async def root():
         "message": "Workout & Diet Planner API is running",
         "version": "2.0.0",
         "status": "healthy",
-        "auth": "secure (bcrypt + database sessions)"
+        "auth": "secure (bcrypt + signed sessions)"
     }
 
 
@@ -289,34 +471,31 @@ async def health_check():
     }
 
 
-@app.post("/generate-plan")
-async def generate_plan(request: PlanRequest) -> Dict[str, Any]:
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """Format a single Server-Sent Events frame"""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+@app.post("/generate-plan", response_class=ORJSONResponse)
+async def generate_plan(request: PlanRequest) -> ORJSONResponse:
     """
     Generate a personalized workout and meal plan based on user input.
     """
     try:
-        # 1. Normalize injuries into a consistent {name, severity} shape
-        injuries: List[Dict[str, str]] = []
-        for i in request.injuries:
-            if isinstance(i, str):
-                injuries.append({"name": i, "severity": "moderate"})
-            elif hasattr(i, "name") and hasattr(i, "severity"):
-                injuries.append({"name": i.name, "severity": i.severity})
-            elif isinstance(i, dict):
-                injuries.append({
-                    "name": i.get("name", ""),
-                    "severity": i.get("severity", "moderate"),
-                })
+        # 1. Injuries were normalized to {name, severity} during validation
+        injuries = request.injury_dicts()
 
         # 2. Generate initial plan from the LLM
-        print(f"Generating plan for goal: {request.goal}")
-        print(f"Allergies: {request.allergies}")
-        print(f"Injuries: {injuries}")
+        logger.debug(
+            "Generating plan for goal: %s, allergies: %s, injuries: %s",
+            request.goal, request.allergies, injuries,
+        )
         
-        raw_plan = generate_plan_from_llm(
+        raw_plan = await generate_plan_coalesced(
             goal=request.goal,
             allergies=request.allergies,
             injuries=injuries,
+            regenerate=request.regenerate,
         )
 
         if "error" in raw_plan:
@@ -324,59 +503,292 @@ async def generate_plan(request: PlanRequest) -> Dict[str, Any]:
 
         # 3. Apply safety + replacement rules
         rules_engine = RulesEngine()
-        safe_plan = rules_engine.apply_rules(
+        safe_plan = await rules_engine.apply_rules(
             plan=raw_plan,
             goal=request.goal,
             allergies=request.allergies,
             injuries=injuries,
         )
 
-        print(f"Plan generated successfully with {len(safe_plan['meals'])} meals and {len(safe_plan['workouts'])} workouts")
+        logger.debug(
+            "Plan generated successfully with %d meals and %d workouts",
+            len(safe_plan["meals"]), len(safe_plan["workouts"]),
+        )
 
-        # 4. Return combined response
-        return {
+        # 4. Return combined response (rendered by orjson directly, skipping jsonable_encoder)
+        return ORJSONResponse({
             "goal": request.goal,
             "safe_plan": {
                 "meals": safe_plan["meals"],
                 "workouts": safe_plan["workouts"],
             },
             "replacements_made": safe_plan["replacements"],
+        })
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error generating plan")
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def plan_event_stream(
+    goal: str, allergies: List[str], injuries: List[Dict[str, str]]
+) -> AsyncIterator[str]:
+    """
+    Run the rules engine on each meal/workout as soon as the LLM finishes it
+    and yield the safe item as an SSE frame.
+    """
+    rules_engine = RulesEngine()
+    used_workout_names: set = set()
+    replacements: Dict[str, List[Dict[str, Any]]] = {"meals": [], "workouts": []}
+
+    try:
+        # The OpenAI stream is blocking, so pull it from a worker thread
+        plan_items = iterate_in_threadpool(stream_plan_from_llm(goal, allergies, injuries))
+        async for section, item in plan_items:
+            if section == "meals":
+                safe_items, made = await rules_engine.apply_allergy_rule([item], allergies, goal)
+                event = "meal"
+            else:
+                safe_items, made = await rules_engine.apply_injury_rule(
+                    [item], injuries, goal, used_workout_names
+                )
+                event = "workout"
+
+            replacements[section].extend(made)
+            for safe_item in safe_items:
+                yield format_sse(event, safe_item)
+
+        yield format_sse("done", {"goal": goal, "replacements_made": replacements})
+
+    except Exception as e:
+        logger.exception("Error streaming plan")
+        yield format_sse("error", {"detail": str(e)})
+
+
+@app.post("/generate-plan/stream")
+async def generate_plan_stream(request: PlanRequest) -> StreamingResponse:
+    """
+    Generate a personalized plan and stream it as Server-Sent Events.
+    Emits one `meal`/`workout` event per safe item as the LLM writes it,
+    then a final `done` event with the replacements made.
+    """
+    injuries = request.injury_dicts()
+    logger.debug("Streaming plan for goal: %s", request.goal)
+
+    return StreamingResponse(
+        plan_event_stream(request.goal, request.allergies, injuries),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+@app.post("/generate-plan-batch")
+async def generate_plan_batch(
+    request: PlanBatchRequest,
+    user_id: str = Depends(require_user),
+) -> Dict[str, Any]:
+    """
+    Queue several plans on the OpenAI Batch API for non-interactive use
+    (e.g. bulk/nightly refreshes). Poll GET /generate-plan-batch/{batch_id} for results.
+    """
+    if not request.requests:
+        raise HTTPException(status_code=400, detail="No plan requests provided")
+
+    plan_requests = [
+        {
+            "goal": r.goal,
+            "allergies": r.allergies,
+            "injuries": r.injury_dicts(),
+        }
+        for r in request.requests
+    ]
+
+    try:
+        return await submit_plan_batch(plan_requests, owner=user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Error submitting plan batch")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/generate-plan-batch/{batch_id}")
+async def get_plan_batch(batch_id: str, user_id: str = Depends(require_user)) -> Dict[str, Any]:
+    """
+    Get the status of one of the user's plan batches; once completed, return
+    every plan after the same safety + replacement rules as /generate-plan.
+    """
+    try:
+        batch = await get_plan_batch_results(batch_id, owner=user_id)
+        if batch is None:
+            raise HTTPException(status_code=404, detail="Plan batch not found")
+
+        rules_engine = RulesEngine()
+
+        async def apply_rules_to(result: Dict[str, Any]) -> Dict[str, Any]:
+            plan_request = result["request"]
+            raw_plan = result["plan"]
+            goal = plan_request.get("goal", "")
+
+            if "error" in raw_plan:
+                return {"goal": goal, "error": raw_plan["error"]}
+
+            safe_plan = await rules_engine.apply_rules(
+                plan=raw_plan,
+                goal=goal,
+                allergies=plan_request.get("allergies", []),
+                injuries=plan_request.get("injuries", []),
+            )
+            return {
+                "goal": goal,
+                "safe_plan": {
+                    "meals": safe_plan["meals"],
+                    "workouts": safe_plan["workouts"],
+                },
+                "replacements_made": safe_plan["replacements"],
+            }
+
+        # Plans are independent, so their rules checks (DB reads, LLM calls) run concurrently
+        plans = await asyncio.gather(*(apply_rules_to(result) for result in batch["plans"]))
+
+        return {
+            "batch_id": batch["batch_id"],
+            "status": batch["status"],
+            "plans": list(plans),
         }
 
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error generating plan: {str(e)}")
+        logger.exception("Error fetching plan batch")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ============================================
+# ADMIN ENDPOINTS
+# ============================================
+
+@app.post("/admin/invalidate-foods")
+async def invalidate_foods(x_admin_token: Optional[str] = Header(None)):
+    """
+    Drop the cached food/exercise catalog, and LLM answers built from it, after
+    editing food_items or exercise_items.
+    Requires the ADMIN_TOKEN env var to be set and sent as the X-Admin-Token header.
+    """
+    admin_token = os.getenv("ADMIN_TOKEN")
+    if not admin_token or not x_admin_token or not secrets.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    invalidate_available_items_cache()
+    invalidate_catalog_rows_cache()
+    invalidate_llm_cache()
+    return {"success": True, "message": "Food and exercise cache cleared"}
+
 # ============================================
 # SAVE PLAN ENDPOINTS
 # ============================================
 
+def insert_plan_rows(
+    supabase: Any,
+    user_id: str,
+    goal: str,
+    meal_rows: List[Dict[str, Any]],
+    workout_rows: List[Dict[str, Any]],
+) -> Any:
+    """
+    Insert a plan with its meals and workouts and return the new plan id.
+    Uses the save_plan() Postgres function (see README) so everything is
+    written atomically in one round trip. If that function hasn't been
+    created, falls back to one bulk insert per table.
+    """
+    try:
+        result = supabase.rpc("save_plan", {
+            "p_user_id": user_id,
+            "p_goal": goal,
+            "p_meals": meal_rows,
+            "p_workouts": workout_rows,
+        }).execute()
+        if result.data is None:
+            raise HTTPException(status_code=500, detail="Failed to create plan")
+        return result.data
+    except APIError as e:
+        if e.code != "PGRST202":  # anything but "function not found"
+            raise
+        logger.warning("save_plan() RPC not found, inserting rows directly")
+
+    # created_at comes from the column default (database clock)
+    plan_result = supabase.table('plans').insert({
+        "user_id": user_id,
+        "goal": goal
+    }).execute()
+    
+    if not plan_result.data:
+        raise HTTPException(status_code=500, detail="Failed to create plan")
+    
+    plan_id = plan_result.data[0]['id']
+    if meal_rows:
+        supabase.table('plan_meals').insert(
+            [{"plan_id": plan_id, **row} for row in meal_rows]
+        ).execute()
+    if workout_rows:
+        supabase.table('plan_workouts').insert(
+            [{"plan_id": plan_id, **row} for row in workout_rows]
+        ).execute()
+    return plan_id
+
+
+# Leading number of a duration given in minutes ("30 min", "45 minutes")
+_DURATION_MINUTES_RE = re.compile(r"^\s*(\d+)(?=.*min)")
+
+def parse_duration_minutes(duration: str, default: int = 30) -> int:
+    """Extract minutes from a duration string (e.g., "30 min" -> 30)"""
+    match = _DURATION_MINUTES_RE.match(duration or "")
+    return int(match.group(1)) if match else default
+
+
+def update_profile_from_plan(
+    user_id: str, goal: str, allergies: Optional[List[str]], injuries: Optional[List[str]]
+) -> None:
+    """
+    Copy a saved plan's goal (and allergies/injuries, when the plan had them)
+    onto the user's profile. Runs as a background task after /api/save-plan responds.
+    """
+    profile_update: Dict[str, Any] = {"goal": goal}
+    
+    # Only update allergies/injuries if they were part of the plan generation
+    if allergies is not None:
+        profile_update['allergies'] = allergies
+    if injuries is not None:
+        profile_update['injuries'] = injuries
+    
+    try:
+        get_supabase_client().table('users').update(profile_update).eq('id', user_id).execute()
+    except Exception:
+        logger.exception("Error updating profile from saved plan")
+
+
 @app.post("/api/save-plan")
-async def save_plan(request: SavePlanRequest, session_id: Optional[str] = Cookie(None)):
+def save_plan(
+    request: SavePlanRequest,
+    background_tasks: BackgroundTasks,
+    user_id: str = Depends(require_user),
+):
     """
     Save a workout and meal plan for the logged-in user.
     Maximum 5 plans per user.
     Also updates user's profile with goal, allergies, and injuries.
     """
-    # Check authentication
-    session_data = get_session(session_id)
-    if not session_data:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    user_id = session_data["user_id"]
     supabase = get_supabase_client()
     
     try:
-        # Check how many plans the user currently has
+        # Count the user's plans; only the oldest row is returned
         existing_plans = supabase.table('plans')\
-            .select('id, created_at, goal')\
+            .select('id, created_at, goal', count='exact')\
             .eq('user_id', user_id)\
             .order('created_at', desc=False)\
+            .limit(1)\
             .execute()
         
-        if len(existing_plans.data) >= 5:
+        if (existing_plans.count or 0) >= 5:
             # Return error indicating they need to delete oldest
             oldest_plan = existing_plans.data[0]
             return {
@@ -390,22 +802,8 @@ async def save_plan(request: SavePlanRequest, session_id: Optional[str] = Cookie
                 }
             }
         
-        # Create the plan
-        plan_result = supabase.table('plans').insert({
-            "user_id": user_id,
-            "goal": request.goal,
-            "created_at": datetime.now().isoformat()
-        }).execute()
-        
-        if not plan_result.data:
-            raise HTTPException(status_code=500, detail="Failed to create plan")
-        
-        plan_id = plan_result.data[0]['id']
-        
-        # Save meals to plan_meals table
-        for meal in request.meals:
-            meal_data = {
-                "plan_id": plan_id,
+        meal_rows = [
+            {
                 "meal_type": meal.get('timeOfDay', meal.get('meal_type', 'Anytime')),
                 "name": meal.get('title', meal.get('name', 'Unnamed Meal')),
                 "calories": int(meal.get('calories', 0)) if meal.get('calories') else 0,
@@ -414,49 +812,29 @@ async def save_plan(request: SavePlanRequest, session_id: Optional[str] = Cookie
                 "fat": int(meal.get('fat', 0)) if meal.get('fat') else 0,
                 "was_replaced": meal.get('was_replaced', False)
             }
-            
-            print(f"Saving meal: {meal_data}")  # Debug logging
-            
-            supabase.table('plan_meals').insert(meal_data).execute()
-        
-        # Save workouts to plan_workouts table
-        for workout in request.workouts:
-            # Extract duration in minutes from duration string (e.g., "30 min" -> 30)
-            duration_str = workout.get('duration', '30 min')
-            duration_minutes = 30  # default
-            if 'min' in duration_str:
-                try:
-                    duration_minutes = int(duration_str.split()[0])
-                except:
-                    duration_minutes = 30
-            
-            workout_data = {
-                "plan_id": plan_id,
+            for meal in request.meals
+        ]
+        
+        workout_rows = [
+            {
                 "name": workout.get('title', workout.get('name', 'Unnamed Workout')),
-                "duration_minutes": duration_minutes,
+                "duration_minutes": parse_duration_minutes(workout.get('duration', '30 min')),
                 "estimated_calories": workout.get('calories', 0),
                 "was_replaced": workout.get('was_replaced', False)
             }
-            
-            print(f"Saving workout: {workout_data}")  # Debug logging
-            
-            supabase.table('plan_workouts').insert(workout_data).execute()
+            for workout in request.workouts
+        ]
         
-        # Update user profile with the plan's goal, allergies, and injuries
-        user_data = supabase.table('users').select('goal, allergies, injuries').eq('id', user_id).execute()
+        logger.debug("Saving plan with meals %s and workouts %s", meal_rows, workout_rows)
         
-        if user_data.data:
-            profile_update = {
-                "goal": request.goal
-            }
-            
-            # Only update allergies/injuries if they were part of the plan generation
-            if hasattr(request, 'allergies') and request.allergies is not None:
-                profile_update['allergies'] = request.allergies
-            if hasattr(request, 'injuries') and request.injuries is not None:
-                profile_update['injuries'] = request.injuries
-            
-            supabase.table('users').update(profile_update).eq('id', user_id).execute()
+        # Plan, meals and workouts in one transaction / round trip
+        plan_id = insert_plan_rows(supabase, user_id, request.goal, meal_rows, workout_rows)
+        plans_cache.delete(user_id)
+        
+        # The profile update isn't part of the response, so run it after sending it
+        background_tasks.add_task(
+            update_profile_from_plan, user_id, request.goal, request.allergies, request.injuries
+        )
         
         return {
             "success": True,
@@ -467,22 +845,16 @@ async def save_plan(request: SavePlanRequest, session_id: Optional[str] = Cookie
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error saving plan: {e}")
+        logger.exception("Error saving plan")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.delete("/api/plans/{plan_id}")
-async def delete_plan(plan_id: str, session_id: Optional[str] = Cookie(None)):
+def delete_plan(plan_id: str, user_id: str = Depends(require_user)):
     """
     Delete a specific plan (and its associated meals/workouts).
     Due to ON DELETE CASCADE, meals and workouts will be automatically deleted.
     """
-    # Check authentication
-    session_data = get_session(session_id)
-    if not session_data:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    user_id = session_data["user_id"]
     supabase = get_supabase_client()
     
     try:
@@ -498,136 +870,164 @@ async def delete_plan(plan_id: str, session_id: Optional[str] = Cookie(None)):
         
         # Delete the plan (meals and workouts will cascade delete automatically)
         supabase.table('plans').delete().eq('id', plan_id).execute()
+        plans_cache.delete(user_id)
         
         return {"success": True, "message": "Plan deleted successfully"}
     
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error deleting plan: {e}")
+        logger.exception("Error deleting plan")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _execute(query) -> Any:
+    """Run a blocking supabase-py query in a worker thread so several can be awaited together"""
+    return await asyncio.to_thread(query.execute)
+
+
+def _enrich_meal(meal: Dict[str, Any], food_items: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Add allergen info from food_items and a smart-matched image to a saved meal"""
+    food_item = food_items.get(meal['name'])
+    
+    return {
+        'name': meal['name'],
+        'meal_type': meal['meal_type'],
+        'calories': meal['calories'],
+        'protein': meal['protein'],
+        'carbs': meal['carbs'],
+        'fat': meal['fat'],
+        'was_replaced': meal['was_replaced'],
+        'allergens': food_item['allergens'] if food_item else [],
+        'image_url': get_smart_food_image(meal['name'])
+    }
+
+
+def _enrich_workout(workout: Dict[str, Any], exercise_items: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Add exercise metadata from exercise_items and a smart-matched image to a saved workout"""
+    exercise_item = exercise_items.get(workout['name'])
+    
+    return {
+        'name': workout['name'],
+        'duration_minutes': workout['duration_minutes'],
+        'estimated_calories': workout['estimated_calories'],
+        'was_replaced': workout['was_replaced'],
+        'category': exercise_item['category'] if exercise_item else None,
+        'difficulty_level': exercise_item['difficulty_level'] if exercise_item else None,
+        'contraindications': exercise_item['contraindications'] if exercise_item else [],
+        'image_url': get_smart_exercise_image(workout['name'])
+    }
+
+
+async def _load_plan_items(supabase, plan_ids: List[Any]) -> tuple:
+    """
+    Fetch the meals and workouts of all given plans plus their catalog rows.
+    One IN-query per table (four in total) instead of one query per plan and per item.
+    """
+    meals_result, workouts_result = await asyncio.gather(
+        _execute(supabase.table('plan_meals').select('*').in_('plan_id', plan_ids)),
+        _execute(supabase.table('plan_workouts').select('*').in_('plan_id', plan_ids)),
+    )
+    
+    food_names = list({meal['name'] for meal in meals_result.data})
+    exercise_names = list({workout['name'] for workout in workouts_result.data})
+    food_result, exercise_result = await asyncio.gather(
+        _execute(supabase.table('food_items').select('name, allergens').in_('name', food_names)),
+        _execute(
+            supabase.table('exercise_items')
+                .select('name, category, difficulty_level, contraindications')
+                .in_('name', exercise_names)
+        ),
+    )
+    
+    food_items = {row['name']: row for row in food_result.data}
+    exercise_items = {row['name']: row for row in exercise_result.data}
+    return meals_result.data, workouts_result.data, food_items, exercise_items
+
+
+async def _build_saved_plans(supabase, plan_rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """The given plans (newest first) with enriched meals and workouts"""
+    if not plan_rows:
+        return {'success': True, 'plans': []}
+    
+    meals, workouts, food_items, exercise_items = await _load_plan_items(
+        supabase, [plan['id'] for plan in plan_rows]
+    )
+    
+    plans = []
+    for plan in plan_rows:
+        enriched_meals = [
+            _enrich_meal(meal, food_items) for meal in meals if meal['plan_id'] == plan['id']
+        ]
+        enriched_workouts = [
+            _enrich_workout(workout, exercise_items)
+            for workout in workouts if workout['plan_id'] == plan['id']
+        ]
+        plans.append({
+            'id': plan['id'],
+            'goal': plan['goal'],
+            'created_at': plan['created_at'],
+            'meals': enriched_meals,
+            'workouts': enriched_workouts,
+            'meal_count': len(enriched_meals),
+            'workout_count': len(enriched_workouts)
+        })
+    
+    return {
+        'success': True,
+        'plans': plans
+    }
+
+
 @app.get("/api/plans")
-async def get_saved_plans(session_id: Optional[str] = Cookie(None)):
+async def get_saved_plans(
+    user_id: str = Depends(require_user),
+    if_none_match: Optional[str] = Header(None),
+):
     """
     Get all saved plans for the logged-in user with their meals and workouts
     Enriches meal data with allergen information and images using smart keyword matching
+    The serialized response is cached per user and served with an ETag, so
+    unchanged plans can be answered with 304 Not Modified.
     """
-    # Check authentication
-    session_data = get_session(session_id)
-    if not session_data:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    user_id = session_data["user_id"]
     supabase = get_supabase_client()
     
     try:
-        # Get all plans for the user
-        plans_result = supabase.table('plans')\
-            .select('*')\
-            .eq('user_id', user_id)\
-            .order('created_at', desc=True)\
-            .execute()
-        
-        plans = []
-        
-        for plan in plans_result.data:
-            plan_id = plan['id']
-            
-            # Get meals for this plan
-            meals_result = supabase.table('plan_meals')\
-                .select('*')\
-                .eq('plan_id', plan_id)\
-                .execute()
-            
-            # Enrich meals with allergen info AND smart IMAGE matching
-            enriched_meals = []
-            for meal in meals_result.data:
-                # Try to find matching food item in database for allergens
-                food_item = supabase.table('food_items')\
-                    .select('allergens')\
-                    .eq('name', meal['name'])\
-                    .execute()
-                
-                # Use smart keyword matching for image
-                image_url = get_smart_food_image(meal['name'])
-                
-                meal_data = {
-                    'name': meal['name'],
-                    'meal_type': meal['meal_type'],
-                    'calories': meal['calories'],
-                    'protein': meal['protein'],
-                    'carbs': meal['carbs'],
-                    'fat': meal['fat'],
-                    'was_replaced': meal['was_replaced'],
-                    'allergens': food_item.data[0]['allergens'] if food_item.data else [],
-                    'image_url': image_url
-                }
-                enriched_meals.append(meal_data)
-            
-            # Get workouts for this plan
-            workouts_result = supabase.table('plan_workouts')\
-                .select('*')\
-                .eq('plan_id', plan_id)\
-                .execute()
-            
-            # Enrich workouts with exercise info AND smart IMAGE matching
-            enriched_workouts = []
-            for workout in workouts_result.data:
-                # Try to find matching exercise item in database for metadata
-                exercise_item = supabase.table('exercise_items')\
-                    .select('category, difficulty_level, contraindications')\
-                    .eq('name', workout['name'])\
-                    .execute()
-                
-                # Use smart keyword matching for image
-                image_url = get_smart_exercise_image(workout['name'])
-                
-                workout_data = {
-                    'name': workout['name'],
-                    'duration_minutes': workout['duration_minutes'],
-                    'estimated_calories': workout['estimated_calories'],
-                    'was_replaced': workout['was_replaced'],
-                    'category': exercise_item.data[0]['category'] if exercise_item.data else None,
-                    'difficulty_level': exercise_item.data[0]['difficulty_level'] if exercise_item.data else None,
-                    'contraindications': exercise_item.data[0]['contraindications'] if exercise_item.data else [],
-                    'image_url': image_url
-                }
-                enriched_workouts.append(workout_data)
-            
-            plans.append({
-                'id': plan['id'],
-                'goal': plan['goal'],
-                'created_at': plan['created_at'],
-                'meals': enriched_meals,
-                'workouts': enriched_workouts,
-                'meal_count': len(enriched_meals),
-                'workout_count': len(enriched_workouts)
-            })
+        # The plan list itself is always read, so a save or delete on another worker
+        # is seen straight away; only the item lookups and enrichment are cached
+        plans_result = await _execute(
+            supabase.table('plans')
+                .select('*')
+                .eq('user_id', user_id)
+                .order('created_at', desc=True)
+        )
+        plan_rows = plans_result.data or []
+        # Saved plans are never edited, so their ids identify this version of the list
+        version = make_cache_key([plan['id'] for plan in plan_rows])[:16]
         
-        return {
-            'success': True,
-            'plans': plans
-        }
-    
+        cached = plans_cache.get(user_id)
+        if cached is None or cached[0] != version:
+            body = orjson.dumps(await _build_saved_plans(supabase, plan_rows))
+            cached = (version, f'"{version}-{hashlib.sha256(body).hexdigest()[:16]}"', body)
+            plans_cache.set(user_id, cached)
     except Exception as e:
-        print(f"Error fetching plans: {e}")
+        logger.exception("Error fetching plans")
         raise HTTPException(status_code=500, detail=str(e))
+    
+    _, etag, body = cached
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
 
 # ============================================
 # IMAGE ENDPOINTS
 # ============================================
 
-@app.get("/api/exercise-image")
-async def get_exercise_image(name: str, session_id: Optional[str] = Cookie(None)):
+@app.get("/api/exercise-image", dependencies=[Depends(require_user)])
+def get_exercise_image(name: str):
     """
     Get image URL for a specific exercise item with smart keyword matching
     """
-    session_data = get_session(session_id)
-    if not session_data:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
     supabase = get_supabase_client()
     
     try:
@@ -643,20 +1043,16 @@ async def get_exercise_image(name: str, session_id: Optional[str] = Cookie(None)
         # Use smart keyword matching
         return {"image_url": get_smart_exercise_image(name)}
     
-    except Exception as e:
-        print(f"Error fetching exercise image: {e}")
+    except Exception:
+        logger.exception("Error fetching exercise image")
         return {"image_url": get_smart_exercise_image(name)}
 
 
-@app.get("/api/food-image")
-async def get_food_image(name: str, session_id: Optional[str] = Cookie(None)):
+@app.get("/api/food-image", dependencies=[Depends(require_user)])
+def get_food_image(name: str):
     """
     Get image URL for a specific food item with smart keyword matching
     """
-    session_data = get_session(session_id)
-    if not session_data:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
     supabase = get_supabase_client()
     
     try:
@@ -672,30 +1068,68 @@ async def get_food_image(name: str, session_id: Optional[str] = Cookie(None)):
         # Use smart keyword matching
         return {"image_url": get_smart_food_image(name)}
     
-    except Exception as e:
-        print(f"Error fetching food image: {e}")
+    except Exception:
+        logger.exception("Error fetching food image")
         return {"image_url": get_smart_food_image(name)}
 
+def lookup_image_urls(supabase, table: str, names: List[str], fallback) -> Dict[str, str]:
+    """
+    Image URLs for many items in one IN-query; names without a stored
+    image_url fall back to smart keyword matching
+    """
+    image_urls: Dict[str, str] = {}
+    try:
+        result = supabase.table(table)\
+            .select('name, image_url')\
+            .in_('name', names)\
+            .execute()
+        image_urls = {row['name']: row['image_url'] for row in result.data if row.get('image_url')}
+    except Exception:
+        logger.exception("Error fetching %s images", table)
+    
+    return {name: image_urls.get(name) or fallback(name) for name in names}
+
+
+@app.post("/api/exercise-images", dependencies=[Depends(require_user)])
+def get_exercise_images(request: ImageBatchRequest):
+    """
+    Get image URLs for several exercise items at once (one database query)
+    """
+    return {
+        "image_urls": lookup_image_urls(
+            get_supabase_client(), 'exercise_items', request.names, get_smart_exercise_image
+        )
+    }
+
+
+@app.post("/api/food-images", dependencies=[Depends(require_user)])
+def get_food_images(request: ImageBatchRequest):
+    """
+    Get image URLs for several food items at once (one database query)
+    """
+    return {
+        "image_urls": lookup_image_urls(
+            get_supabase_client(), 'food_items', request.names, get_smart_food_image
+        )
+    }
+
 # ============================================
 # PROFILE ENDPOINTS
 # ============================================
 
 @app.get("/api/profile")
-async def get_profile(session_id: Optional[str] = Cookie(None)):
+def get_profile(user_id: str = Depends(require_user)):
     """
     Get the current user's profile data
     """
-    # Check authentication
-    session_data = get_session(session_id)
-    if not session_data:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    user_id = session_data["user_id"]
     supabase = get_supabase_client()
     
     try:
         # Get user data
-        result = supabase.table('users').select('*').eq('id', user_id).execute()
+        result = supabase.table('users')\
+            .select('id, name, email, age, height, weight, goal, allergies, injuries')\
+            .eq('id', user_id)\
+            .execute()
         
         if not result.data:
             raise HTTPException(status_code=404, detail="User not found")
@@ -717,40 +1151,20 @@ async def get_profile(session_id: Optional[str] = Cookie(None)):
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error getting profile: {e}")
+        logger.exception("Error getting profile")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.put("/api/profile")
-async def update_profile(request: UpdateProfileRequest, session_id: Optional[str] = Cookie(None)):
+def update_profile(request: UpdateProfileRequest, user_id: str = Depends(require_user)):
     """
     Update the current user's profile data
     """
-    # Check authentication
-    session_data = get_session(session_id)
-    if not session_data:
-        raise HTTPException(status_code=401, detail="Not authenticated")
-    
-    user_id = session_data["user_id"]
     supabase = get_supabase_client()
     
     try:
-        # Build update dict with only provided fields
-        update_data = {}
-        if request.name is not None:
-            update_data['name'] = request.name
-        if request.age is not None:
-            update_data['age'] = request.age
-        if request.height is not None:
-            update_data['height'] = request.height
-        if request.weight is not None:
-            update_data['weight'] = request.weight
-        if request.goal is not None:
-            update_data['goal'] = request.goal
-        if request.allergies is not None:
-            update_data['allergies'] = request.allergies
-        if request.injuries is not None:
-            update_data['injuries'] = request.injuries
+        # Build update dict with only provided fields (the model ignores unknown keys)
+        update_data = request.model_dump(exclude_none=True)
         
         # Update user data
         result = supabase.table('users').update(update_data).eq('id', user_id).execute()
@@ -766,7 +1180,7 @@ async def update_profile(request: UpdateProfileRequest, session_id: Optional[str
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error updating profile: {e}")
+        logger.exception("Error updating profile")
         raise HTTPException(status_code=500, detail=str(e))
 
 # ============================================
@@ -775,4 +1189,14 @@ async def update_profile(request: UpdateProfileRequest, session_id: Optional[str
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Each worker is its own process (own Supabase/OpenAI clients and caches), so
+    # more than one is opt-in via WEB_CONCURRENCY; "auto" picks uvloop and
+    # httptools when they're installed
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="auto",
+        http="auto",
+    )
\ No newline at end of file
@@ -1,14 +1,62 @@
 # backend/rules_engine.py
 
-from typing import List, Dict, Any, Optional
+import asyncio
+import functools
+import logging
+from typing import List, Dict, Any, Iterator, Optional
 
 from database import get_supabase_client
+from utils.cache import TTLCache
 from llm_service import (
-    validate_exercise_safety,
+    validate_exercises_batch,
     suggest_food_replacement,
     suggest_exercise_replacement,
 )
 
+logger = logging.getLogger(__name__)
+
+# Exercise-name keywords ruled out outright for an (injury, severity) pair,
+# before any DB or LLM check
+SEVERITY_KEYWORDS: Dict[tuple[str, str], frozenset[str]] = {
+    ("knee", "severe"): frozenset({"squat", "lunge", "leg press", "leg", "calf"}),
+    ("wrist", "severe"): frozenset({"push-up", "push up", "bench", "press"}),
+}
+
+# Only the columns the rules read from catalog rows (substitutes and fallbacks)
+FOOD_ITEM_COLUMNS = "name, calories, protein, carbs, fat, allergens"
+EXERCISE_ITEM_COLUMNS = "name, category, estimated_calories_per_minute, contraindications"
+
+# Catalog rows (foods, exercises, substitution rules) change rarely, so the rules
+# engine shares them across requests for 5 minutes instead of re-reading Supabase.
+# The rules only read these rows, so every caller gets the same objects, uncopied
+catalog_rows_cache = TTLCache(maxsize=16, ttl=300, copy=False)
+
+
+def invalidate_catalog_rows_cache() -> None:
+    """Drop cached catalog rows so the next rules check re-reads Supabase."""
+    catalog_rows_cache.clear()
+
+
+def _cached_catalog_rows(method):
+    """Cache a no-argument RulesEngine query method's rows; empty results (errors) aren't cached."""
+    @functools.wraps(method)
+    def wrapper(self):
+        rows = catalog_rows_cache.get(method.__name__)
+        if rows is None:
+            rows = method(self)
+            if rows:
+                catalog_rows_cache.set(method.__name__, rows)
+        return rows
+    return wrapper
+
+
+def _unique_ignoring_case(values: List[str]) -> List[str]:
+    """Case-insensitive dedupe that keeps the first spelling of each value, in order."""
+    first_by_lower: Dict[str, str] = {}
+    for value in values:
+        first_by_lower.setdefault(value.lower(), value)
+    return list(first_by_lower.values())
+
 
 class RulesEngine:
     """
@@ -23,107 +71,133 @@ class RulesEngine:
 
     # ---------- DB HELPER QUERIES ---------- #
 
+    @_cached_catalog_rows
     def get_food_items(self) -> List[Dict[str, Any]]:
         try:
             resp = (
                 self.supabase.table("food_items")
-                .select("*")
+                .select(FOOD_ITEM_COLUMNS)
                 .eq("is_active", True)
                 .execute()
             )
             return resp.data or []
-        except Exception as e:
-            print(f"Error fetching food items: {e}")
+        except Exception:
+            logger.exception("Error fetching food items")
             return []
 
+    @_cached_catalog_rows
     def get_exercise_items(self) -> List[Dict[str, Any]]:
         try:
             resp = (
                 self.supabase.table("exercise_items")
-                .select("*")
+                .select(EXERCISE_ITEM_COLUMNS)
                 .eq("is_active", True)
                 .execute()
             )
             return resp.data or []
-        except Exception as e:
-            print(f"Error fetching exercise items: {e}")
+        except Exception:
+            logger.exception("Error fetching exercise items")
             return []
 
     # ---------- ALLERGY LOGIC ---------- #
 
+    @_cached_catalog_rows
+    def get_food_allergen_index(self) -> List[tuple[str, List[str]]]:
+        """
+        (lowercased name, allergens) for every food item, in one query, so a
+        whole plan's meals can be checked without a round trip per meal.
+        """
+        try:
+            resp = self.supabase.table("food_items").select("name, allergens").execute()
+            return [
+                ((row.get("name") or "").lower(), [a.lower() for a in row.get("allergens") or []])
+                for row in resp.data or []
+            ]
+        except Exception:
+            logger.exception("Error fetching food allergens")
+            return []
+
     def check_food_has_allergen(
-        self, food_name: str, allergens: List[str]
+        self,
+        food_name: str,
+        allergens: List[str],
+        food_index: Optional[List[tuple[str, List[str]]]] = None,
     ) -> tuple[bool, Optional[str]]:
         """
         Check if a given food name contains any of the user's allergens,
         using DB allergens field if available, then falling back to simple matching.
+        Pass `food_index` (from get_food_allergen_index) when checking many foods.
         """
-        try:
-            resp = (
-                self.supabase.table("food_items")
-                .select("allergens")
-                .ilike("name", f"%{food_name}%")
-                .limit(1)
-                .execute()
-            )
-
-            if resp.data:
-                food_allergens = resp.data[0].get("allergens") or []
-                for allergen in allergens:
-                    for food_allergen in food_allergens:
-                        if allergen.lower() in food_allergen.lower() or food_allergen.lower() in allergen.lower():
-                            return True, allergen
-
-            # Fallback: simple name-based match
-            for allergen in allergens:
-                if allergen.lower() in food_name.lower():
+        if food_index is None:
+            food_index = self.get_food_allergen_index()
+
+        # First food item whose name contains this food's name (like ILIKE '%name%')
+        name_lower = food_name.lower()
+        food_allergens = next(
+            (item_allergens for item_name, item_allergens in food_index if name_lower in item_name),
+            [],
+        )
+        allergens_lower = [(allergen, allergen.lower()) for allergen in allergens]
+        for allergen, allergen_lower in allergens_lower:
+            for food_allergen in food_allergens:
+                if allergen_lower in food_allergen or food_allergen in allergen_lower:
                     return True, allergen
 
-            return False, None
+        # Fallback: simple name-based match
+        for allergen, allergen_lower in allergens_lower:
+            if allergen_lower in name_lower:
+                return True, allergen
 
-        except Exception as e:
-            print(f"Error checking food allergen: {e}")
-            for allergen in allergens:
-                if allergen.lower() in food_name.lower():
-                    return True, allergen
-            return False, None
+        return False, None
 
-    def find_food_substitute(self, allergen: str) -> Optional[Dict[str, Any]]:
-        """
-        Try to find a defined substitution in 'food_substitutions' table.
-        Fallback to any food that doesn't contain that allergen.
-        """
+    @_cached_catalog_rows
+    def get_food_substitution_rules(self) -> List[Dict[str, Any]]:
+        """All food substitution rules with their substitute food, by priority"""
         try:
-            # Look up a specific substitution rule
             resp = (
                 self.supabase.table("food_substitutions")
                 .select(
-                    "substitute_food_id, food_items!food_substitutions_substitute_food_id_fkey(*)"
+                    f"allergen, food_items!food_substitutions_substitute_food_id_fkey({FOOD_ITEM_COLUMNS})"
                 )
-                .ilike("allergen", f"%{allergen}%")
                 .order("priority")
-                .limit(1)
                 .execute()
             )
+            return resp.data or []
+        except Exception:
+            logger.exception("Error fetching food substitutions")
+            return []
 
-            if resp.data:
-                substitute = resp.data[0].get("food_items")
-                if substitute:
-                    return substitute
-
-            # Fallback: any active food without that allergen
-            for food in self.get_food_items():
-                food_allergens = food.get("allergens") or []
-                if allergen.lower() not in [a.lower() for a in food_allergens]:
-                    return food
-
-            return None
-
-        except Exception as e:
-            print(f"Error finding food substitute for {allergen}: {e}")
-            return None
-
-    def apply_allergy_rule(
+    def find_food_substitute(
+        self,
+        allergen: str,
+        substitution_rules: Optional[List[Dict[str, Any]]] = None,
+        food_items: Optional[List[Dict[str, Any]]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Try to find a defined substitution in 'food_substitutions' table.
+        Fallback to any food that doesn't contain that allergen.
+        Pass prefetched `substitution_rules` / `food_items` when looking up several allergens.
+        """
+        if substitution_rules is None:
+            substitution_rules = self.get_food_substitution_rules()
+
+        # Highest-priority rule whose allergen mentions this one (like ILIKE '%allergen%')
+        allergen_lower = allergen.lower()
+        for rule in substitution_rules:
+            if allergen_lower in (rule.get("allergen") or "").lower() and rule.get("food_items"):
+                return rule["food_items"]
+
+        # Fallback: any active food without that allergen
+        if food_items is None:
+            food_items = self.get_food_items()
+        for food in food_items:
+            food_allergens = food.get("allergens") or []
+            if not any(a.lower() == allergen_lower for a in food_allergens):
+                return food
+
+        return None
+
+    async def apply_allergy_rule(
         self, meals: List[Dict[str, Any]], allergies: List[str], goal: str
     ) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
         """
@@ -131,133 +205,216 @@ class RulesEngine:
           - Check if it violates any allergy
           - If yes, try DB-based substitute
           - If DB fails, ask LLM for a safe replacement
+        All LLM replacements for the plan are requested concurrently.
         """
         if not allergies:
             return meals, []
 
+        # Case-insensitive dedupe so repeated allergens aren't rescanned for every meal
+        allergies = _unique_ignoring_case(allergies)
+
+        # 1. DB checks: (meal, matched allergen, DB substitute) per meal.
+        # Allergens for all foods come in one query; the Supabase client is blocking,
+        # so queries run in worker threads.
+        food_index = await asyncio.to_thread(self.get_food_allergen_index)
+        allergen_checks = [
+            self.check_food_has_allergen(meal.get("name", ""), allergies, food_index)
+            for meal in meals
+        ]
+        matched_allergens = [
+            allergen if has_allergen else None for has_allergen, allergen in allergen_checks
+        ]
+        # One substitute per distinct allergen, however many meals it flags
+        db_substitutes: Dict[str, Optional[Dict[str, Any]]] = {}
+        if any(matched_allergens):
+            substitution_rules, food_items = await asyncio.gather(
+                asyncio.to_thread(self.get_food_substitution_rules),
+                asyncio.to_thread(self.get_food_items),
+            )
+            db_substitutes = {
+                allergen: self.find_food_substitute(allergen, substitution_rules, food_items)
+                for allergen in set(matched_allergens)
+                if allergen
+            }
+        checked: List[tuple[Dict[str, Any], Optional[str], Optional[Dict[str, Any]]]] = [
+            (meal, allergen, db_substitutes.get(allergen) if allergen else None)
+            for meal, allergen in zip(meals, matched_allergens)
+        ]
+
+        # 2. Ask the LLM for every replacement the DB couldn't provide, in parallel
+        llm_subs = iter(
+            await asyncio.gather(
+                *(
+                    suggest_food_replacement(meal.get("name", ""), allergen, goal)
+                    for meal, allergen, substitute in checked
+                    if allergen and not substitute
+                )
+            )
+        )
+
+        # 3. Assemble the plan in the original order
         safe_meals: List[Dict[str, Any]] = []
         replacements: List[Dict[str, Any]] = []
 
-        for meal in meals:
+        for meal, allergen, substitute in checked:
             name = meal.get("name", "")
-            has_allergen, allergen = self.check_food_has_allergen(name, allergies)
 
-            if has_allergen and allergen:
-                # Try DB-based substitution first
-                substitute = self.find_food_substitute(allergen)
-                if substitute:
-                    new_meal = {
-                        "name": substitute.get("name", "Safe Meal"),
-                        "calories": substitute.get(
-                            "calories", meal.get("calories", 0)
-                        ),
-                        "protein": substitute.get("protein", 0),
-                        "carbs": substitute.get("carbs", 0),
-                        "fat": substitute.get("fat", 0),
+            if not allergen:
+                safe_meals.append(meal)
+            elif substitute:
+                new_meal = {
+                    "name": substitute.get("name", "Safe Meal"),
+                    "calories": substitute.get(
+                        "calories", meal.get("calories", 0)
+                    ),
+                    "protein": substitute.get("protein", 0),
+                    "carbs": substitute.get("carbs", 0),
+                    "fat": substitute.get("fat", 0),
+                }
+                safe_meals.append(new_meal)
+                replacements.append(
+                    {
+                        "replaced": name,
+                        "with": new_meal["name"],
+                        "reason": f"{allergen} allergy (DB substitution)",
                     }
-                    safe_meals.append(new_meal)
-                    replacements.append(
-                        {
-                            "replaced": name,
-                            "with": new_meal["name"],
-                            "reason": f"{allergen} allergy (DB substitution)",
-                        }
-                    )
-                else:
-                    # Ask LLM for a safe replacement
-                    llm_sub = suggest_food_replacement(name, allergen, goal)
-                    safe_meals.append(llm_sub)
-                    replacements.append(
-                        {
-                            "replaced": name,
-                            "with": llm_sub["name"],
-                            "reason": f"{allergen} allergy (LLM substitution)",
-                        }
-                    )
+                )
             else:
-                safe_meals.append(meal)
+                llm_sub = next(llm_subs)
+                safe_meals.append(llm_sub)
+                replacements.append(
+                    {
+                        "replaced": name,
+                        "with": llm_sub["name"],
+                        "reason": f"{allergen} allergy (LLM substitution)",
+                    }
+                )
 
         return safe_meals, replacements
 
     # ---------- INJURY / EXERCISE LOGIC ---------- #
 
-    def check_exercise_has_contraindication(
-        self, exercise_name: str, injury_names: List[str]
-    ) -> tuple[bool, Optional[str]]:
+    @_cached_catalog_rows
+    def get_exercise_contraindication_index(self) -> List[tuple[str, List[str]]]:
         """
-        Check if an exercise has contraindications for any of the user's injuries,
-        using the DB exercise_items.contraindications field if available.
-        Returns (True, matched_injury_name) or (False, None).
+        (lowercased name, contraindications) for every exercise item, in one
+        query, so a whole plan's workouts can be checked without a round trip each.
         """
         try:
             resp = (
                 self.supabase.table("exercise_items")
-                .select("contraindications")
-                .ilike("name", f"%{exercise_name}%")
-                .limit(1)
+                .select("name, contraindications")
                 .execute()
             )
+            return [
+                ((row.get("name") or "").lower(), [c.lower() for c in row.get("contraindications") or []])
+                for row in resp.data or []
+            ]
+        except Exception:
+            logger.exception("Error fetching exercise contraindications")
+            return []
 
-            if resp.data:
-                contraindications = resp.data[0].get("contraindications") or []
-                for injury in injury_names:
-                    for c in contraindications:
-                        if injury.lower() in c.lower() or c.lower() in injury.lower():
-                            return True, injury
-
-            # Fallback: simple string matching
-            for injury in injury_names:
-                if injury.lower() in exercise_name.lower():
+    def check_exercise_has_contraindication(
+        self,
+        exercise_name: str,
+        injury_names: List[str],
+        exercise_index: Optional[List[tuple[str, List[str]]]] = None,
+    ) -> tuple[bool, Optional[str]]:
+        """
+        Check if an exercise has contraindications for any of the user's injuries,
+        using the DB exercise_items.contraindications field if available.
+        Returns (True, matched_injury_name) or (False, None).
+        Pass `exercise_index` (from get_exercise_contraindication_index) when checking many exercises.
+        """
+        if exercise_index is None:
+            exercise_index = self.get_exercise_contraindication_index()
+
+        # First exercise item whose name contains this exercise's name (like ILIKE '%name%')
+        name_lower = exercise_name.lower()
+        contraindications = next(
+            (contras for item_name, contras in exercise_index if name_lower in item_name),
+            [],
+        )
+        injuries_lower = [(injury, injury.lower()) for injury in injury_names]
+        for injury, injury_lower in injuries_lower:
+            for c in contraindications:
+                if injury_lower in c or c in injury_lower:
                     return True, injury
 
-            return False, None
+        # Fallback: simple string matching
+        for injury, injury_lower in injuries_lower:
+            if injury_lower in name_lower:
+                return True, injury
 
-        except Exception as e:
-            print(f"Error checking exercise contraindication: {e}")
-            for injury in injury_names:
-                if injury.lower() in exercise_name.lower():
-                    return True, injury
-            return False, None
+        return False, None
 
-    def find_exercise_substitute(self, injury_name: str) -> Optional[Dict[str, Any]]:
-        """
-        Try to find an exercise substitution rule in 'exercise_substitutions' table.
-        Fallback to any exercise without that contraindication.
-        """
+    @_cached_catalog_rows
+    def get_exercise_substitution_rules(self) -> List[Dict[str, Any]]:
+        """All exercise substitution rules with their substitute exercise, by priority"""
         try:
             resp = (
                 self.supabase.table("exercise_substitutions")
                 .select(
-                    "substitute_exercise_id, exercise_items!exercise_substitutions_substitute_exercise_id_fkey(*)"
+                    f"contraindication, exercise_items!exercise_substitutions_substitute_exercise_id_fkey({EXERCISE_ITEM_COLUMNS})"
                 )
-                .ilike("contraindication", f"%{injury_name}%")
                 .order("priority")
-                .limit(1)
                 .execute()
             )
+            return resp.data or []
+        except Exception:
+            logger.exception("Error fetching exercise substitutions")
+            return []
 
-            if resp.data:
-                substitute = resp.data[0].get("exercise_items")
-                if substitute:
-                    return substitute
-
-            # Fallback: any active exercise without that contraindication
-            for ex in self.get_exercise_items():
-                contras = ex.get("contraindications") or []
-                if injury_name.lower() not in [c.lower() for c in contras]:
-                    return ex
-
-            return None
+    def exercise_substitute_candidates(
+        self,
+        injury_name: str,
+        substitution_rules: Optional[List[Dict[str, Any]]] = None,
+        exercise_items: Optional[List[Dict[str, Any]]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Ranked substitutes for an injury: 'exercise_substitutions' rules by priority,
+        then every exercise without that contraindication.
+        Pass prefetched `substitution_rules` / `exercise_items` when looking up several injuries.
+        """
+        if substitution_rules is None:
+            substitution_rules = self.get_exercise_substitution_rules()
+        if exercise_items is None:
+            exercise_items = self.get_exercise_items()
+
+        # Rules whose contraindication mentions the injury (like ILIKE '%injury%')
+        injury_lower = injury_name.lower()
+        candidates = [
+            rule["exercise_items"]
+            for rule in substitution_rules
+            if injury_lower in (rule.get("contraindication") or "").lower() and rule.get("exercise_items")
+        ]
+        # Fallback: any active exercise without that contraindication
+        candidates.extend(
+            ex
+            for ex in exercise_items
+            if not any(c.lower() == injury_lower for c in ex.get("contraindications") or [])
+        )
+        return candidates
 
-        except Exception as e:
-            print(f"Error finding exercise substitute for {injury_name}: {e}")
-            return None
+    def find_exercise_substitute(
+        self,
+        injury_name: str,
+        substitution_rules: Optional[List[Dict[str, Any]]] = None,
+        exercise_items: Optional[List[Dict[str, Any]]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Try to find an exercise substitution rule in 'exercise_substitutions' table.
+        Fallback to any exercise without that contraindication.
+        """
+        candidates = self.exercise_substitute_candidates(injury_name, substitution_rules, exercise_items)
+        return candidates[0] if candidates else None
 
-    def apply_injury_rule(
+    async def apply_injury_rule(
         self,
         workouts: List[Dict[str, Any]],
         injuries: List[Dict[str, str]],
         goal: str,
+        used_workout_names: Optional[set] = None,
     ) -> tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
         """
         For each workout:
@@ -266,6 +423,13 @@ class RulesEngine:
         - Ask LLM if exercise is safe
         - Substitute with DB rule or LLM recommendation if unsafe
         - ENSURES NO DUPLICATE WORKOUTS in the final list
+
+        All LLM safety checks go out in a single batched call. Substitutes are
+        drawn from a ranked DB candidate pool per injury; the LLM is asked at
+        most once per workout, and only when that pool is used up.
+
+        Pass `used_workout_names` to keep deduplicating across several calls
+        (e.g. when workouts are streamed in one at a time).
         """
         if not injuries:
             return workouts, []
@@ -273,117 +437,136 @@ class RulesEngine:
         safe_workouts: List[Dict[str, Any]] = []
         replacements: List[Dict[str, Any]] = []
 
-        injury_names = [i["name"] for i in injuries]
+        # Case-insensitive dedupe so repeated injuries aren't rescanned for every workout
+        injury_names = _unique_ignoring_case([i["name"] for i in injuries])
         
         # Track workout names to avoid duplicates
-        used_workout_names = set()
+        if used_workout_names is None:
+            used_workout_names = set()
 
-        for w in workouts:
-            w_name = w.get("name", "")
-            unsafe = False
+        # Injury that makes each workout unsafe (None = no rule fired)
+        matched_injuries: List[Optional[str]] = []
+
+        # --- 1. DB-based contraindication checks, against all exercises fetched in one query ---
+        # (the Supabase client is blocking, so queries run in worker threads)
+        exercise_index = await asyncio.to_thread(self.get_exercise_contraindication_index)
+        contra_checks = [
+            self.check_exercise_has_contraindication(w.get("name", ""), injury_names, exercise_index)
+            for w in workouts
+        ]
+
+        # Lowercased once here rather than for every workout
+        injuries_lower = [(i["name"].lower(), i.get("severity", "moderate").lower()) for i in injuries]
+
+        for w, (has_contra, inj_name) in zip(workouts, contra_checks):
+            w_lower = w.get("name", "").lower()
             matched_injury_name: Optional[str] = None
-            matched_injury: Optional[Dict[str, str]] = None
 
-            # --- 1. DB-based contraindication check ---
-            has_contra, inj_name = self.check_exercise_has_contraindication(
-                w_name, injury_names
-            )
             if has_contra and inj_name:
-                unsafe = True
                 matched_injury_name = inj_name
-                matched_injury = next(
-                    (i for i in injuries if i["name"].lower() == inj_name.lower()),
-                    {"name": inj_name, "severity": "moderate"},
-                )
 
             # --- 2. Severity-based keyword rules (extra strict for "severe") ---
-            if not unsafe:
-                for i in injuries:
-                    name = i["name"].lower()
-                    severity = i.get("severity", "moderate").lower()
-                    w_lower = w_name.lower()
-
-                    if name == "knee" and severity == "severe":
-                        if any(
-                            kw in w_lower
-                            for kw in ["squat", "lunge", "leg press", "leg", "calf"]
-                        ):
-                            unsafe = True
-                            matched_injury_name = name
-                            matched_injury = i
-                            break
-
-                    if name == "wrist" and severity == "severe":
-                        if any(
-                            kw in w_lower for kw in ["push-up", "push up", "bench", "press"]
-                        ):
-                            unsafe = True
-                            matched_injury_name = name
-                            matched_injury = i
-                            break
-
-            # --- 3. LLM-based safety check if still unclear ---
-            if not unsafe:
-                is_safe = validate_exercise_safety(w_name, injuries, goal)
-                if not is_safe:
-                    unsafe = True
+            if not matched_injury_name:
+                for name, severity in injuries_lower:
+                    keywords = SEVERITY_KEYWORDS.get((name, severity))
+                    if keywords and any(kw in w_lower for kw in keywords):
+                        matched_injury_name = name
+                        break
+
+            matched_injuries.append(matched_injury_name)
+
+        # --- 3. LLM-based safety check for everything still unclear, in one call ---
+        unclear = [idx for idx, matched in enumerate(matched_injuries) if not matched]
+        if unclear:
+            verdicts = await validate_exercises_batch(
+                [workouts[idx].get("name", "") for idx in unclear], injuries, goal
+            )
+            for idx in unclear:
+                if not verdicts.get(workouts[idx].get("name", ""), False):
                     # If we don't know which specific injury, just pick the first
-                    matched_injury = injuries[0]
-                    matched_injury_name = matched_injury["name"]
+                    matched_injuries[idx] = injuries[0]["name"]
+
+        # Ranked DB candidates per injury; workouts whose injury has none get their
+        # LLM suggestion prefetched all at once
+        unsafe = [idx for idx, matched in enumerate(matched_injuries) if matched]
+        candidate_pools: Dict[str, Iterator[Dict[str, Any]]] = {}
+        needs_llm: List[int] = []
+        if unsafe:
+            substitution_rules, exercise_items = await asyncio.gather(
+                asyncio.to_thread(self.get_exercise_substitution_rules),
+                asyncio.to_thread(self.get_exercise_items),
+            )
+            no_candidates: set = set()
+            for injury in {matched_injuries[idx] for idx in unsafe}:
+                candidates = self.exercise_substitute_candidates(injury, substitution_rules, exercise_items)
+                if not candidates:
+                    no_candidates.add(injury)
+                candidate_pools[injury] = iter(candidates)
+            needs_llm = [idx for idx in unsafe if matched_injuries[idx] in no_candidates]
+        prefetched_subs = dict(
+            zip(
+                needs_llm,
+                await asyncio.gather(
+                    *(suggest_exercise_replacement(workouts[idx].get("name", ""), injuries, goal) for idx in needs_llm)
+                ),
+            )
+        )
+
+        for idx, w in enumerate(workouts):
+            w_name = w.get("name", "")
+            matched_injury_name = matched_injuries[idx]
 
             # --- 4. Substitution if unsafe ---
-            if unsafe and matched_injury_name:
-                # Try to find a replacement that's not already in the list
-                max_attempts = 5
-                replacement_found = False
-                
-                for attempt in range(max_attempts):
-                    # First try DB substitution
-                    if attempt == 0:
-                        substitute = self.find_exercise_substitute(matched_injury_name)
-                        if substitute:
-                            new_name = substitute.get("name", "Safe Alternative Exercise")
-                            if new_name.lower() not in used_workout_names:
-                                new_workout = {
-                                    "name": new_name,
-                                    "duration": w.get("duration", "3 sets of 10"),
-                                    "category": substitute.get("category", ""),
-                                    "estimated_calories": substitute.get("estimated_calories_per_minute", 5) * 30,  # Estimate
-                                }
-                                safe_workouts.append(new_workout)
-                                used_workout_names.add(new_name.lower())
-                                replacements.append(
-                                    {
-                                        "replaced": w_name,
-                                        "with": new_workout["name"],
-                                        "reason": f"{matched_injury_name} contraindication (DB substitution)",
-                                    }
-                                )
-                                replacement_found = True
-                                break
-                    
-                    # Ask the LLM for a replacement
-                    llm_sub = suggest_exercise_replacement(w_name, injuries, goal)
-                    llm_name = llm_sub.get("name", "Safe Alternative Exercise")
-                    
-                    # Check if this replacement is already used
-                    if llm_name.lower() not in used_workout_names:
-                        safe_workouts.append(llm_sub)
-                        used_workout_names.add(llm_name.lower())
-                        replacements.append(
-                            {
-                                "replaced": w_name,
-                                "with": llm_sub["name"],
-                                "reason": f"{matched_injury_name} contraindication (LLM substitution)",
-                            }
-                        )
-                        replacement_found = True
-                        break
-                    else:
-                        print(f"Attempt {attempt + 1}: Replacement '{llm_name}' already used, retrying...")
-                
-                # If we couldn't find a unique replacement after all attempts, use a generic fallback
-                if not replacement_found:
+            if matched_injury_name:
+                # Next DB candidate that's not already in the list; candidates skipped
+                # here stay used, so the pool is only ever walked once per injury
+                substitute = next(
+                    (
+                        c
+                        for c in candidate_pools[matched_injury_name]
+                        if c.get("name", "Safe Alternative Exercise").lower() not in used_workout_names
+                    ),
+                    None,
+                )
+                if substitute:
+                    new_name = substitute.get("name", "Safe Alternative Exercise")
+                    new_workout = {
+                        "name": new_name,
+                        "duration": w.get("duration", "3 sets of 10"),
+                        "category": substitute.get("category", ""),
+                        "estimated_calories": substitute.get("estimated_calories_per_minute", 5) * 30,  # Estimate
+                    }
+                    safe_workouts.append(new_workout)
+                    used_workout_names.add(new_name.lower())
+                    replacements.append(
+                        {
+                            "replaced": w_name,
+                            "with": new_workout["name"],
+                            "reason": f"{matched_injury_name} contraindication (DB substitution)",
+                        }
+                    )
+                    continue
+
+                # Pool exhausted: ask the LLM once (the answer may already be prefetched)
+                if idx in prefetched_subs:
+                    llm_sub = prefetched_subs.pop(idx)
+                else:
+                    llm_sub = await suggest_exercise_replacement(w_name, injuries, goal)
+                llm_name = llm_sub.get("name", "Safe Alternative Exercise")
+
+                if llm_name.lower() not in used_workout_names:
+                    safe_workouts.append(llm_sub)
+                    used_workout_names.add(llm_name.lower())
+                    replacements.append(
+                        {
+                            "replaced": w_name,
+                            "with": llm_sub["name"],
+                            "reason": f"{matched_injury_name} contraindication (LLM substitution)",
+                        }
+                    )
+                else:
+                    # The LLM repeated a name already in the plan, use a generic fallback
+                    logger.debug("Replacement '%s' already used, falling back", llm_name)
                     fallback_name = f"Alternative Exercise {len(safe_workouts) + 1}"
                     fallback_workout = {
                         "name": fallback_name,
@@ -405,13 +588,13 @@ class RulesEngine:
                     safe_workouts.append(w)
                     used_workout_names.add(w_name.lower())
                 else:
-                    print(f"Skipping duplicate safe workout: {w_name}")
+                    logger.debug("Skipping duplicate safe workout: %s", w_name)
 
         return safe_workouts, replacements
 
     # ---------- MASTER ENTRY POINT ---------- #
 
-    def apply_rules(
+    async def apply_rules(
         self,
         plan: Dict[str, Any],
         goal: str,
@@ -422,12 +605,19 @@ class RulesEngine:
         Main function:
           - apply allergy rules to meals
           - apply injury rules to workouts
+        The two are independent, so their DB reads and LLM calls overlap.
         """
-        meals, meal_replacements = self.apply_allergy_rule(
-            plan.get("meals", []), allergies, goal
-        )
-        workouts, workout_replacements = self.apply_injury_rule(
-            plan.get("workouts", []), injuries, goal
+        if not allergies and not injuries:
+            # Nothing to check: skip both passes (and their tasks) entirely
+            return {
+                "meals": plan.get("meals", []),
+                "workouts": plan.get("workouts", []),
+                "replacements": {"meals": [], "workouts": []},
+            }
+
+        (meals, meal_replacements), (workouts, workout_replacements) = await asyncio.gather(
+            self.apply_allergy_rule(plan.get("meals", []), allergies, goal),
+            self.apply_injury_rule(plan.get("workouts", []), injuries, goal),
         )
 
         return {
@@ -11,8 +11,24 @@ import os
 # Add backend directory to path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+# Minimum bcrypt work factor: hashing, not mocking, is what makes the auth tests slow
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+
 from main import app
 from database import get_supabase_client
+from main import session_cache, revoked_sessions, plans_cache
+from llm_service import llm_cache, catalog_cache
+from rules_engine import catalog_rows_cache
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Keep cached LLM answers, catalog data, sessions and saved plans from leaking between tests"""
+    for cache in (llm_cache, catalog_cache, catalog_rows_cache, session_cache, revoked_sessions, plans_cache):
+        cache.clear()
+    yield
+    for cache in (llm_cache, catalog_cache, catalog_rows_cache, session_cache, revoked_sessions, plans_cache):
+        cache.clear()
 
 @pytest.fixture
 def client():
@@ -5,7 +5,7 @@ Testing HTTP request/response handling
 """
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import json
 
 class TestAPIEndpoints:
@@ -30,6 +30,17 @@ class TestAPIEndpoints:
         assert data["status"] == "healthy"
         assert data["api"] == "running"
     
+    def test_health_endpoint_cors_preflight(self, client):
+        """Test preflights from the frontend origin are allowed and cacheable"""
+        response = client.options("/health", headers={
+            "Origin": "http://localhost:5173",
+            "Access-Control-Request-Method": "GET",
+        })
+        
+        assert response.status_code == 200
+        assert response.headers["access-control-allow-origin"] == "http://localhost:5173"
+        assert response.headers["access-control-max-age"] == "86400"
+    
     @patch('main.get_supabase_client')
     @patch('main.hash_password')
     def test_signup_success(self, mock_hash, mock_supabase, client):
@@ -37,9 +48,8 @@ class TestAPIEndpoints:
         # Mock hash
         mock_hash.return_value = "$2b$12$test_hash"
         
-        # Mock database - no existing user
+        # Mock database - insert succeeds
         mock_db = MagicMock()
-        mock_db.table().select().eq().execute.return_value = MagicMock(data=[])
         mock_db.table().insert().execute.return_value = MagicMock(
             data=[{"id": "user-123", "name": "testuser"}]
         )
@@ -56,14 +66,17 @@ class TestAPIEndpoints:
         data = response.json()
         assert "message" in data
         assert "success" in data["message"].lower()
+        mock_db.table().select.assert_not_called()
     
     @patch('main.get_supabase_client')
     def test_signup_username_taken(self, mock_supabase, client):
         """Test signup fails when username exists"""
-        # Mock database - existing user
+        from postgrest.exceptions import APIError
+        
+        # Mock database - insert hits the unique constraint on users.email
         mock_db = MagicMock()
-        mock_db.table().select().eq().execute.return_value = MagicMock(
-            data=[{"id": "existing-user", "email": "testuser"}]
+        mock_db.table().insert().execute.side_effect = APIError(
+            {"code": "23505", "message": "duplicate key value violates unique constraint"}
         )
         mock_supabase.return_value = mock_db
         
@@ -113,6 +126,24 @@ class TestAPIEndpoints:
         assert "message" in data
         assert response.cookies.get("session_id") == "session-token-123"
     
+    @patch('main.verify_password')
+    @patch('main.get_supabase_client')
+    def test_login_rejects_locked_account(self, mock_supabase, mock_verify, client):
+        """Test accounts with a locked password hash are rejected without running bcrypt"""
+        mock_db = MagicMock()
+        mock_db.table().select().eq().execute.return_value = MagicMock(
+            data=[{"id": "user-123", "name": "testuser", "email": "testuser", "password_hash": "!"}]
+        )
+        mock_supabase.return_value = mock_db
+        
+        response = client.post("/api/login", json={
+            "username": "testuser",
+            "password": "testpass123"
+        })
+        
+        assert response.status_code == 401
+        mock_verify.assert_not_called()
+    
     @patch('main.get_supabase_client')
     def test_login_invalid_credentials(self, mock_supabase, client):
         """Test login fails with invalid credentials"""
@@ -147,7 +178,7 @@ class TestAPIEndpoints:
         assert "logged out" in data["message"].lower()
         mock_delete.assert_called_once()
     
-    @patch('main.generate_plan_from_llm')
+    @patch('main.generate_plan_coalesced')
     @patch('main.RulesEngine')
     def test_generate_plan_success(self, mock_rules_engine, mock_llm, client, sample_llm_response):
         """Test successful plan generation"""
@@ -156,6 +187,7 @@ class TestAPIEndpoints:
         
         # Mock rules engine
         mock_engine = MagicMock()
+        mock_engine.apply_rules = AsyncMock()
         mock_engine.apply_rules.return_value = {
             "meals": sample_llm_response["meals"],
             "workouts": sample_llm_response["workouts"],
@@ -178,6 +210,136 @@ class TestAPIEndpoints:
         assert "workouts" in data["safe_plan"]
         assert len(data["safe_plan"]["meals"]) == 4
         assert len(data["safe_plan"]["workouts"]) == 4
+        assert mock_llm.call_args.kwargs["regenerate"] is False
+    
+    @patch('main.stream_plan_from_llm')
+    @patch('main.RulesEngine')
+    def test_generate_plan_stream_emits_events(self, mock_rules_engine, mock_stream, client, sample_llm_response):
+        """Test streamed plan generation emits one SSE frame per item plus a done frame"""
+        mock_stream.return_value = iter(
+            [("meals", m) for m in sample_llm_response["meals"][:2]] +
+            [("workouts", w) for w in sample_llm_response["workouts"][:1]]
+        )
+        
+        # Rules engine passes items through unchanged
+        mock_engine = MagicMock()
+        mock_engine.apply_allergy_rule = AsyncMock(side_effect=lambda items, *args: (items, []))
+        mock_engine.apply_injury_rule = AsyncMock(side_effect=lambda items, *args: (items, []))
+        mock_rules_engine.return_value = mock_engine
+        
+        response = client.post("/generate-plan/stream", json={
+            "goal": "build muscle",
+            "injuries": ["knee injury"]
+        })
+        
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = [line.split(": ", 1)[1] for line in response.text.splitlines() if line.startswith("event: ")]
+        assert events == ["meal", "meal", "workout", "done"]
+        mock_stream.assert_called_once_with(
+            "build muscle", [], [{"name": "knee injury", "severity": "moderate"}]
+        )
+    
+    @patch('main.get_session')
+    def test_generate_plan_batch_rejects_oversized_batch(self, mock_get_session, client):
+        """Test batch endpoint refuses more requests than fit in one batch"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        client.cookies.set("session_id", "valid-session")
+        response = client.post("/generate-plan-batch", json={
+            "requests": [{"goal": "build muscle"}] * 15
+        })
+        
+        assert response.status_code == 400
+    
+    @patch('main.get_plan_batch_results')
+    @patch('main.submit_plan_batch')
+    def test_plan_batch_endpoints_require_login(self, mock_submit, mock_results, client):
+        """Test batches can't be queued or read without a session"""
+        submitted = client.post("/generate-plan-batch", json={"requests": [{"goal": "build muscle"}]})
+        fetched = client.get("/generate-plan-batch/batch-1")
+        
+        assert submitted.status_code == 401
+        assert fetched.status_code == 401
+        mock_submit.assert_not_called()
+        mock_results.assert_not_called()
+    
+    @patch('main.get_session')
+    @patch('main.submit_plan_batch')
+    def test_generate_plan_batch_records_owner(self, mock_submit, mock_get_session, client):
+        """Test queued batches are tagged with the logged-in user"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        mock_submit.return_value = {"batch_id": "batch-1", "status": "validating"}
+        client.cookies.set("session_id", "valid-session")
+        
+        response = client.post("/generate-plan-batch", json={"requests": [{"goal": "build muscle"}]})
+        
+        assert response.status_code == 200
+        assert mock_submit.call_args.kwargs["owner"] == "user-123"
+    
+    @patch('main.get_session')
+    @patch('main.RulesEngine')
+    @patch('main.get_plan_batch_results')
+    def test_get_plan_batch_applies_rules_concurrently(self, mock_results, mock_rules_engine, mock_get_session, client):
+        """Test batch results are rule-checked concurrently, keeping order and per-plan errors"""
+        import asyncio
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        client.cookies.set("session_id", "valid-session")
+        mock_results.return_value = {
+            "batch_id": "batch-1",
+            "status": "completed",
+            "plans": [
+                {"request": {"goal": "build muscle"}, "plan": {"meals": [], "workouts": []}},
+                {"request": {"goal": "lose weight"}, "plan": {"error": "Invalid JSON"}},
+                {"request": {"goal": "stay fit"}, "plan": {"meals": [], "workouts": []}},
+            ],
+        }
+        in_flight = []
+        max_in_flight = 0
+        
+        async def apply_rules(plan, goal, allergies, injuries):
+            nonlocal max_in_flight
+            in_flight.append(goal)
+            max_in_flight = max(max_in_flight, len(in_flight))
+            await asyncio.sleep(0)
+            in_flight.remove(goal)
+            return {"meals": [], "workouts": [], "replacements": {"meals": [], "workouts": []}}
+        
+        mock_rules_engine.return_value.apply_rules = AsyncMock(side_effect=apply_rules)
+        
+        response = client.get("/generate-plan-batch/batch-1")
+        
+        assert response.status_code == 200
+        plans = response.json()["plans"]
+        assert [p["goal"] for p in plans] == ["build muscle", "lose weight", "stay fit"]
+        assert plans[1] == {"goal": "lose weight", "error": "Invalid JSON"}
+        assert max_in_flight == 2
+        mock_results.assert_called_once_with("batch-1", owner="user-123")
+    
+    @patch('main.get_session')
+    @patch('main.get_plan_batch_results', return_value=None)
+    def test_get_plan_batch_unknown_batch_returns_404(self, mock_results, mock_get_session, client):
+        """Test a batch that doesn't exist, isn't a plan batch or isn't the user's is a 404, not a 500"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        client.cookies.set("session_id", "valid-session")
+        response = client.get("/generate-plan-batch/batch-unknown")
+        
+        assert response.status_code == 404
+    
+    @patch('main.invalidate_available_items_cache')
+    def test_invalidate_foods_requires_admin_token(self, mock_invalidate, client, monkeypatch):
+        """Test catalog cache invalidation is only allowed with the admin token, and drops cached LLM answers"""
+        from llm_service import llm_cache
+        monkeypatch.setenv("ADMIN_TOKEN", "secret-token")
+        llm_cache.set("plan-key", {"meals": [], "workouts": []})
+        
+        denied = client.post("/admin/invalidate-foods", headers={"X-Admin-Token": "wrong"})
+        assert llm_cache.get("plan-key") is not None
+        allowed = client.post("/admin/invalidate-foods", headers={"X-Admin-Token": "secret-token"})
+        
+        assert denied.status_code == 403
+        assert allowed.status_code == 200
+        mock_invalidate.assert_called_once()
+        assert llm_cache.get("plan-key") is None
     
     @patch('main.get_session')
     @patch('main.get_supabase_client')
@@ -211,10 +373,214 @@ class TestAPIEndpoints:
         assert "plans" in data
         assert data["success"] is True
     
+    @patch('main.get_session')
+    @patch('main.get_supabase_client')
+    def test_get_saved_plans_batches_lookups(self, mock_supabase, mock_get_session, client):
+        """Test plan items and their catalog rows are fetched with one IN-query per table"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        
+        tables = {name: MagicMock() for name in ["plans", "plan_meals", "plan_workouts", "food_items", "exercise_items"]}
+        tables["plans"].select().eq().order().execute.return_value = MagicMock(data=[
+            {"id": "plan-1", "goal": "build muscle", "created_at": "2024-01-02T00:00:00Z"},
+            {"id": "plan-2", "goal": "lose weight", "created_at": "2024-01-01T00:00:00Z"},
+        ])
+        tables["plan_meals"].select().in_().execute.return_value = MagicMock(data=[
+            {"plan_id": "plan-2", "name": "Oats", "meal_type": "Breakfast", "calories": 300,
+             "protein": 10, "carbs": 50, "fat": 5, "was_replaced": False},
+        ])
+        tables["plan_workouts"].select().in_().execute.return_value = MagicMock(data=[
+            {"plan_id": "plan-1", "name": "Squats", "duration_minutes": 20,
+             "estimated_calories": 150, "was_replaced": False},
+        ])
+        tables["food_items"].select().in_().execute.return_value = MagicMock(data=[
+            {"name": "Oats", "allergens": ["gluten"]},
+        ])
+        tables["exercise_items"].select().in_().execute.return_value = MagicMock(data=[])
+        mock_db = MagicMock()
+        mock_db.table.side_effect = lambda name: tables[name]
+        mock_supabase.return_value = mock_db
+        
+        client.cookies.set("session_id", "valid-session")
+        response = client.get("/api/plans")
+        
+        assert response.status_code == 200
+        plans = response.json()["plans"]
+        assert [p["meal_count"] for p in plans] == [0, 1]
+        assert plans[1]["meals"][0]["allergens"] == ["gluten"]
+        assert plans[0]["workouts"][0]["contraindications"] == []
+        tables["plan_meals"].select().in_.assert_called_with("plan_id", ["plan-1", "plan-2"])
+        tables["food_items"].select().eq.assert_not_called()
+    
+    @patch('main.get_session')
+    @patch('main.get_supabase_client')
+    def test_get_saved_plans_cached_with_etag(self, mock_supabase, mock_get_session, client):
+        """Test repeat requests reuse the cached response, with 304 when the ETag matches"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        
+        tables = {name: MagicMock() for name in ["plans", "plan_meals", "plan_workouts", "food_items", "exercise_items"]}
+        tables["plans"].select().eq().order().execute.return_value = MagicMock(data=[
+            {"id": "plan-1", "goal": "build muscle", "created_at": "2024-01-01T00:00:00Z"},
+        ])
+        for name in ["plan_meals", "plan_workouts", "food_items", "exercise_items"]:
+            tables[name].select().in_().execute.return_value = MagicMock(data=[])
+            tables[name].select.reset_mock()
+        mock_db = MagicMock()
+        mock_db.table.side_effect = lambda name: tables[name]
+        mock_supabase.return_value = mock_db
+        
+        client.cookies.set("session_id", "valid-session")
+        first = client.get("/api/plans")
+        second = client.get("/api/plans", headers={"If-None-Match": first.headers["etag"]})
+        
+        assert first.status_code == 200
+        assert [p["id"] for p in first.json()["plans"]] == ["plan-1"]
+        assert second.status_code == 304
+        assert tables["plan_meals"].select.call_count == 1
+        
+        # A plan saved on another worker (this cache was never told) changes the list's version
+        tables["plans"].select().eq().order().execute.return_value = MagicMock(data=[
+            {"id": "plan-2", "goal": "lose weight", "created_at": "2024-01-02T00:00:00Z"},
+            {"id": "plan-1", "goal": "build muscle", "created_at": "2024-01-01T00:00:00Z"},
+        ])
+        third = client.get("/api/plans", headers={"If-None-Match": first.headers["etag"]})
+        
+        assert third.status_code == 200
+        assert [p["id"] for p in third.json()["plans"]] == ["plan-2", "plan-1"]
+        assert third.headers["etag"] != first.headers["etag"]
+        assert tables["plan_meals"].select.call_count == 2
+    
     def test_get_saved_plans_unauthenticated(self, client):
         """Test retrieving saved plans fails when not authenticated"""
         # Execute without session cookie
         response = client.get("/api/plans")
         
         # Verify
-        assert response.status_code == 401
\ No newline at end of file
+        assert response.status_code == 401
+    
+    @patch('main.get_session')
+    @patch('main.get_supabase_client')
+    def test_food_images_batch(self, mock_supabase, mock_get_session, client):
+        """Test batch image lookup uses one IN-query and falls back to keyword matching"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        
+        mock_db = MagicMock()
+        mock_db.table().select().in_().execute.return_value = MagicMock(
+            data=[{"name": "Oats", "image_url": "https://example.com/oats.jpg"}]
+        )
+        mock_supabase.return_value = mock_db
+        
+        client.cookies.set("session_id", "valid-session")
+        response = client.post("/api/food-images", json={"names": ["Oats", "Grilled Salmon"]})
+        
+        assert response.status_code == 200
+        image_urls = response.json()["image_urls"]
+        assert image_urls["Oats"] == "https://example.com/oats.jpg"
+        assert "2374946" in image_urls["Grilled Salmon"]
+        mock_db.table().select().in_.assert_called_with("name", ["Oats", "Grilled Salmon"])
+    
+    @patch('main.get_session')
+    @patch('main.get_supabase_client')
+    def test_save_plan_uses_single_rpc(self, mock_supabase, mock_get_session, client):
+        """Test a plan with its meals and workouts is saved through one save_plan RPC"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        
+        mock_db = MagicMock()
+        mock_db.table().select().eq().order().limit().execute.return_value = MagicMock(data=[], count=0)
+        mock_db.rpc().execute.return_value = MagicMock(data="plan-1")
+        mock_db.rpc.reset_mock()
+        mock_supabase.return_value = mock_db
+        
+        client.cookies.set("session_id", "valid-session")
+        response = client.post("/api/save-plan", json={
+            "goal": "build muscle",
+            "meals": [{"title": "Oats", "calories": 300}],
+            "workouts": [{"title": "Squats", "duration": "20 min", "calories": 150}]
+        })
+        
+        assert response.status_code == 200
+        assert response.json()["plan_id"] == "plan-1"
+        name, params = mock_db.rpc.call_args.args
+        assert name == "save_plan"
+        assert params["p_meals"][0]["name"] == "Oats"
+        assert params["p_workouts"][0]["duration_minutes"] == 20
+        mock_db.table().insert.assert_not_called()
+        # Profile update ran as a background task after the response
+        mock_db.table().update.assert_called_once_with({"goal": "build muscle"})
+    
+    @patch('main.get_session')
+    @patch('main.get_supabase_client')
+    def test_update_profile_sends_only_provided_fields(self, mock_supabase, mock_get_session, client):
+        """Test profile updates skip fields that were omitted or null"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        
+        mock_db = MagicMock()
+        mock_db.table().update().eq().execute.return_value = MagicMock(data=[{"id": "user-123"}])
+        mock_db.table().update.reset_mock()
+        mock_supabase.return_value = mock_db
+        
+        client.cookies.set("session_id", "valid-session")
+        response = client.put("/api/profile", json={"age": 30, "goal": None, "allergies": [], "role": "admin"})
+        
+        assert response.status_code == 200
+        mock_db.table().update.assert_called_once_with({"age": 30, "allergies": []})
+    
+    @patch('main.get_session')
+    @patch('main.get_supabase_client')
+    def test_save_plan_rejects_sixth_plan(self, mock_supabase, mock_get_session, client):
+        """Test the plan limit uses an exact count and reports the oldest plan"""
+        mock_get_session.return_value = {"user_id": "user-123", "username": "testuser"}
+        
+        mock_db = MagicMock()
+        mock_db.table().select().eq().order().limit().execute.return_value = MagicMock(
+            data=[{"id": "plan-1", "goal": "lose weight", "created_at": "2024-01-01T00:00:00Z"}], count=5
+        )
+        mock_supabase.return_value = mock_db
+        
+        client.cookies.set("session_id", "valid-session")
+        response = client.post("/api/save-plan", json={"goal": "build muscle", "meals": [], "workouts": []})
+        
+        assert response.json()["error"] == "max_plans_reached"
+        assert response.json()["oldest_plan"]["id"] == "plan-1"
+        mock_db.table().select.assert_called_with('id, created_at, goal', count='exact')
+        mock_db.rpc.assert_not_called()
+    
+    def test_insert_plan_rows_without_rpc(self):
+        """Test plan rows fall back to bulk inserts when save_plan() doesn't exist"""
+        from main import insert_plan_rows
+        from postgrest.exceptions import APIError
+        
+        mock_db = MagicMock()
+        mock_db.rpc().execute.side_effect = APIError({"code": "PGRST202", "message": "not found"})
+        mock_db.table().insert().execute.return_value = MagicMock(data=[{"id": "plan-1"}])
+        mock_db.table.reset_mock()
+        
+        plan_id = insert_plan_rows(mock_db, "user-123", "lose weight", [{"name": "Oats"}], [{"name": "Plank"}])
+        
+        assert plan_id == "plan-1"
+        assert [c.args[0] for c in mock_db.table.call_args_list] == ["plans", "plan_meals", "plan_workouts"]
+        mock_db.table().insert.assert_called_with([{"plan_id": "plan-1", "name": "Plank"}])
+    
+    def test_parse_duration_minutes(self):
+        """Test workout durations in minutes are parsed, anything else gets the default"""
+        from main import parse_duration_minutes
+        
+        assert parse_duration_minutes("45 minutes") == 45
+        assert parse_duration_minutes("20min") == 20
+        assert parse_duration_minutes("3 sets of 10") == 30
+        assert parse_duration_minutes("") == 30
+    
+    def test_plan_request_normalizes_injuries(self):
+        """Test bare names and {name, severity} objects both validate into Injury models"""
+        from main import PlanRequest
+        
+        request = PlanRequest(goal="build muscle", injuries=[
+            "knee injury",
+            {"name": "wrist pain"},
+            {"name": "back pain", "severity": "severe"},
+        ])
+        
+        assert request.injury_dicts() == [
+            {"name": "knee injury", "severity": "moderate"},
+            {"name": "wrist pain", "severity": "moderate"},
+            {"name": "back pain", "severity": "severe"},
+        ]
@@ -5,7 +5,9 @@ Testing critical security components
 """
 import pytest
 from unittest.mock import Mock, patch, MagicMock
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import base64
+import json
 import bcrypt
 from main import (
     hash_password,
@@ -35,6 +37,14 @@ class TestAuthentication:
         
         assert hash1 != hash2  # Different due to random salt
     
+    @patch('main.BCRYPT_ROUNDS', 5)
+    def test_hash_password_uses_configured_rounds(self):
+        """Test the bcrypt work factor comes from BCRYPT_ROUNDS"""
+        hashed = hash_password("test_password_123")
+        
+        assert hashed.startswith("$2b$05$")
+        assert verify_password("test_password_123", hashed)
+    
     def test_verify_password_correct_password(self):
         """Test password verification succeeds with correct password"""
         password = "test_password_123"
@@ -63,58 +73,127 @@ class TestAuthentication:
     
     @patch('main.get_supabase_client')
     def test_create_session_generates_valid_token(self, mock_supabase):
-        """Test session creation generates cryptographically secure token"""
-        # Mock database
+        """Test session creation returns a signed token, checked once for revocation then cached"""
         mock_db = MagicMock()
-        mock_db.table().insert().execute.return_value = MagicMock(data=[{"session_id": "test"}])
+        mock_db.table().select().eq().limit().execute.return_value = MagicMock(data=[])
         mock_supabase.return_value = mock_db
+        mock_db.table.reset_mock()
         
         # Execute
         session_id = create_session("user-123", "testuser")
         
+        # Creating a session writes nothing
+        mock_db.table.assert_not_called()
+        
         # Verify
         assert session_id is not None
         assert len(session_id) >= 32  # Sufficient entropy
         assert isinstance(session_id, str)
+        assert get_session(session_id) == {"user_id": "user-123", "username": "testuser"}
+        assert get_session(session_id) == {"user_id": "user-123", "username": "testuser"}
         
-        # Verify database call
-        mock_db.table.assert_called_with('sessions')
-        mock_db.table().insert.assert_called_once()
+        # One revocation lookup, then served from cache
+        mock_db.table.assert_called_once_with('revoked_sessions')
     
-    @patch('main.get_supabase_client')
-    def test_create_session_sets_correct_expiration(self, mock_supabase):
+    def test_create_session_sets_correct_expiration(self):
         """Test session expiration is set to 7 days from now"""
-        # Mock database
-        mock_db = MagicMock()
-        captured_data = {}
-        
-        def capture_insert(data):
-            captured_data.update(data)
-            return mock_db
-        
-        mock_db.table().insert.side_effect = capture_insert
-        mock_db.table().insert().execute.return_value = MagicMock(data=[{}])
-        mock_supabase.return_value = mock_db
-        
         # Execute
-        before_time = datetime.now()
         session_id = create_session("user-123", "testuser")
-        after_time = datetime.now()
         
         # Verify expiration is ~7 days from now
-        expires_at = datetime.fromisoformat(captured_data["expires_at"])
+        payload = session_id.split(".")[0]
+        data = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        expires_at = datetime.fromtimestamp(data["exp"])
         expected_expiration = datetime.now() + timedelta(days=7)
         
         # Allow 1 minute margin for test execution time
         assert abs((expires_at - expected_expiration).total_seconds()) < 60
     
+    def test_get_session_rejects_tampered_token(self):
+        """Test a token whose payload was changed no longer verifies"""
+        session_id = create_session("user-123", "testuser")
+        payload, signature = session_id.split(".")
+        forged = base64.urlsafe_b64encode(b'{"uid":"admin","name":"x","exp":9999999999}').decode().rstrip("=")
+        
+        assert get_session(f"{forged}.{signature}") is None
+        assert get_session(f"{payload}.bad-signature") is None
+    
+    @patch('main.get_supabase_client')
+    def test_non_ascii_token_is_invalid_not_an_error(self, mock_supabase):
+        """Test a cookie with non-ASCII characters is rejected instead of raising"""
+        mock_db = MagicMock()
+        mock_supabase.return_value = mock_db
+        
+        assert get_session("abc.d\u00e9f") is None
+        assert get_session("ab\u00e9.def") is None
+        delete_session("ab\u00e9.d\u00e9f")
+        mock_db.table().upsert.assert_not_called()
+    
+    @patch('main.time')
+    def test_get_session_expired_token(self, mock_time):
+        """Test signed tokens stop working once expired"""
+        mock_time.time.return_value = 1_700_000_000
+        session_id = create_session("user-123", "testuser")
+        mock_time.time.return_value += timedelta(days=8).total_seconds()
+        
+        assert get_session(session_id) is None
+    
+    @patch('main.get_supabase_client')
+    def test_delete_session_revokes_token(self, mock_supabase):
+        """Test logging out records the signed token in the shared revoked_sessions table"""
+        mock_db = MagicMock()
+        mock_db.table().select().eq().limit().execute.return_value = MagicMock(data=[])
+        mock_supabase.return_value = mock_db
+        session_id = create_session("user-123", "testuser")
+        assert get_session(session_id) is not None
+        
+        delete_session(session_id)
+        
+        assert get_session(session_id) is None
+        row = mock_db.table().upsert.call_args.args[0]
+        assert row["signature"] == session_id.split(".")[1]
+        assert datetime.fromisoformat(row["expires_at"]) > datetime.now(timezone.utc)
+    
+    @patch('main.get_supabase_client')
+    def test_get_session_honours_revocation_from_other_worker(self, mock_supabase):
+        """Test a token revoked elsewhere (row in revoked_sessions) is rejected"""
+        session_id = create_session("user-123", "testuser")
+        mock_db = MagicMock()
+        mock_db.table().select().eq().limit().execute.return_value = MagicMock(
+            data=[{"signature": session_id.split(".")[1]}]
+        )
+        mock_supabase.return_value = mock_db
+        
+        assert get_session(session_id) is None
+    
+    @patch('main.get_supabase_client')
+    def test_get_session_trusts_signature_when_revocation_check_fails(self, mock_supabase):
+        """Test a database outage doesn't log out holders of validly signed tokens"""
+        session_id = create_session("user-123", "testuser")
+        mock_db = MagicMock()
+        mock_db.table().select().eq().limit().execute.side_effect = Exception("Database error")
+        mock_supabase.return_value = mock_db
+        
+        assert get_session(session_id) == {"user_id": "user-123", "username": "testuser"}
+    
+    @patch('main.get_supabase_client')
+    def test_delete_session_ignores_forged_token(self, mock_supabase):
+        """Test logging out with a badly signed token records nothing"""
+        mock_db = MagicMock()
+        mock_supabase.return_value = mock_db
+        payload = create_session("user-123", "testuser").split(".")[0]
+        
+        delete_session(f"{payload}.bad-signature")
+        
+        mock_db.table().upsert.assert_not_called()
+    
     @patch('main.get_supabase_client')
     def test_get_session_valid_session(self, mock_supabase):
         """Test retrieving valid non-expired session"""
         # Mock database response with valid session
         future_time = datetime.now() + timedelta(days=5)
         mock_db = MagicMock()
-        mock_db.table().select().eq().execute.return_value = MagicMock(
+        mock_db.table().select().eq().gt().execute.return_value = MagicMock(
             data=[{
                 "session_id": "test-session-123",
                 "user_id": "user-456",
@@ -137,36 +216,58 @@ class TestAuthentication:
         assert result["username"] == "Test User"
     
     @patch('main.get_supabase_client')
-    def test_get_session_expired_session(self, mock_supabase):
-        """Test expired session returns None and gets deleted"""
-        # Mock database response with expired session
-        past_time = datetime.now() - timedelta(days=1)
+    def test_get_session_cached_until_deleted(self, mock_supabase):
+        """Test valid sessions are served from cache and evicted on delete"""
+        future_time = datetime.now() + timedelta(days=5)
         mock_db = MagicMock()
-        mock_db.table().select().eq().execute.return_value = MagicMock(
+        mock_db.table().select().eq().gt().execute.return_value = MagicMock(
             data=[{
-                "session_id": "expired-session",
+                "session_id": "test-session-123",
                 "user_id": "user-456",
-                "expires_at": past_time.isoformat() + "Z",
+                "expires_at": future_time.isoformat() + "Z",
                 "users": {"id": "user-456", "name": "Test User", "email": "test@example.com"}
             }]
         )
         mock_supabase.return_value = mock_db
+        mock_db.table().select.reset_mock()
+        
+        first = get_session("test-session-123")
+        second = get_session("test-session-123")
+        
+        assert first == second == {"user_id": "user-456", "username": "Test User"}
+        assert mock_db.table().select.call_count == 1
+        
+        delete_session("test-session-123")
+        get_session("test-session-123")
+        assert mock_db.table().select.call_count == 2
+    
+    @patch('main.get_supabase_client')
+    def test_get_session_expired_session(self, mock_supabase):
+        """Test expired sessions are filtered out by the database query"""
+        # Postgres returns no row for an expired session
+        mock_db = MagicMock()
+        mock_db.table().select().eq().gt().execute.return_value = MagicMock(data=[])
+        mock_supabase.return_value = mock_db
         
         # Execute
+        before_time = datetime.now(timezone.utc)
         result = get_session("expired-session")
         
         # Verify
         assert result is None
         
-        # Verify session was deleted
-        mock_db.table().delete().eq.assert_called()
+        # Verify expiry was checked server-side, not with a delete
+        column, cutoff = mock_db.table().select().eq().gt.call_args.args
+        assert column == "expires_at"
+        assert datetime.fromisoformat(cutoff) >= before_time
+        mock_db.table().delete.assert_not_called()
     
     @patch('main.get_supabase_client')
     def test_get_session_nonexistent_session(self, mock_supabase):
         """Test nonexistent session returns None"""
         # Mock empty database response
         mock_db = MagicMock()
-        mock_db.table().select().eq().execute.return_value = MagicMock(data=[])
+        mock_db.table().select().eq().gt().execute.return_value = MagicMock(data=[])
         mock_supabase.return_value = mock_db
         
         # Execute
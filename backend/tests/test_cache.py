@@ -0,0 +1,75 @@
+# backend/tests/test_cache.py
+"""
+Unit tests for the in-process TTL cache
+Testing expiry, LRU eviction and key stability
+"""
+import pytest
+from unittest.mock import patch
+from utils.cache import TTLCache, make_cache_key
+
+class TestTTLCache:
+    """Test suite for cache behaviour"""
+
+    def test_get_returns_stored_value(self):
+        """Test stored values are returned until they expire"""
+        cache = TTLCache(maxsize=4, ttl=60)
+        cache.set("a", {"name": "Squats"})
+
+        assert cache.get("a") == {"name": "Squats"}
+        assert cache.get("missing") is None
+
+    def test_get_returns_copy(self):
+        """Test mutating a returned value does not change the cached one"""
+        cache = TTLCache()
+        cache.set("a", {"meals": []})
+        cache.get("a")["meals"].append("Eggs")
+
+        assert cache.get("a") == {"meals": []}
+
+    def test_get_without_copy_shares_value(self):
+        """Test copy=False hands back the stored object itself"""
+        cache = TTLCache(copy=False)
+        rows = [{"name": "Oats"}]
+        cache.set("a", rows)
+
+        assert cache.get("a") is rows
+
+    @patch('utils.cache.time.monotonic')
+    def test_entries_expire(self, mock_time):
+        """Test entries are dropped once their TTL has passed"""
+        mock_time.return_value = 100.0
+        cache = TTLCache(ttl=10)
+        cache.set("a", 1)
+
+        mock_time.return_value = 111.0
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    @patch('utils.cache.time.monotonic')
+    def test_refresh_on_get_extends_expiry(self, mock_time):
+        """Test reads push the expiry back when refresh_on_get is set"""
+        mock_time.return_value = 100.0
+        cache = TTLCache(ttl=10, refresh_on_get=True)
+        cache.set("a", 1)
+
+        mock_time.return_value = 108.0
+        assert cache.get("a") == 1
+        mock_time.return_value = 115.0
+        assert cache.get("a") == 1
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted first"""
+        cache = TTLCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+        assert cache.get("c") == 3
+
+    def test_make_cache_key_ignores_dict_order(self):
+        """Test equivalent dicts produce the same key"""
+        assert make_cache_key({"a": 1, "b": 2}) == make_cache_key({"b": 2, "a": 1})
+        assert make_cache_key("plan", "x") != make_cache_key("plan", "y")
@@ -142,4 +142,15 @@ class TestImageMatching:
     def test_exercise_image_numbers_in_name(self):
         """Test handling of numbers in exercise name"""
         url = get_smart_exercise_image("100 Push-Ups Challenge")
-        assert "4162487" in url  # Should still match push-up
\ No newline at end of file
+        assert "4162487" in url  # Should still match push-up
+
+    def test_food_image_memoized_by_normalized_name(self):
+        """Test names differing only in case/whitespace share one cached match"""
+        from utils.images import _match_food_image
+        
+        _match_food_image.cache_clear()
+        get_smart_food_image("Grilled Salmon")
+        url = get_smart_food_image("  grilled salmon ")
+        
+        assert "2374946" in url
+        assert _match_food_image.cache_info().hits == 1
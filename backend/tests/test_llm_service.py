@@ -4,16 +4,37 @@ Unit tests for LLM service (OpenAI integration)
 Testing the most critical component for plan generation
 """
 import pytest
-from unittest.mock import Mock, patch, MagicMock
+from unittest.mock import Mock, patch, MagicMock, AsyncMock
 import json
+import httpx
+from openai import NotFoundError
+import asyncio
+from types import SimpleNamespace
 from llm_service import (
     generate_plan_from_llm,
+    generate_plan_coalesced,
     validate_exercise_safety,
+    validate_exercises_batch,
     suggest_food_replacement,
     suggest_exercise_replacement,
-    _safe_json_from_model_content
+    stream_plan_from_llm,
+    submit_plan_batch,
+    get_plan_batch_results,
+    get_available_foods_and_exercises,
+    _safe_json_from_model_content,
+    _iter_plan_items,
+    _build_plan_messages,
+    PLAN_SCHEMA,
+    SAFETY_MODEL,
+    SAFETY_TOKENS_PER_EXERCISE
 )
 
+
+def _llm_response(content: str = "") -> SimpleNamespace:
+    """Stand-in for a chat completion: only choices[0].message.content is read"""
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
 class TestLLMService:
     """Test suite for LLM service functionality"""
     
@@ -35,9 +56,97 @@ class TestLLMService:
         result = _safe_json_from_model_content(content)
         assert result == {"meals": [], "workouts": []}
     
+    def test_safe_json_from_model_content_with_surrounding_prose(self):
+        """Test parsing JSON preceded and followed by plain text"""
+        content = 'Here is your plan: {"meals": [{"name": "Oats"}], "workouts": []} Enjoy!'
+        result = _safe_json_from_model_content(content)
+        assert result == {"meals": [{"name": "Oats"}], "workouts": []}
+    
+    @patch('llm_service.supabase')
+    def test_available_foods_and_exercises_cached(self, mock_db):
+        """Test the catalog is read with one RPC and then served from cache"""
+        mock_db.rpc().execute.return_value = MagicMock(
+            data={"foods": ["Salmon", "Eggs"], "exercises": ["Squats", "Plank"]}
+        )
+        mock_db.rpc.reset_mock()
+        
+        first = get_available_foods_and_exercises()
+        second = get_available_foods_and_exercises()
+        
+        # Names are sorted so the prompt prefix stays stable
+        assert first == second == (("Eggs", "Salmon"), ("Plank", "Squats"))
+        mock_db.rpc.assert_called_once_with("active_catalog")
+        mock_db.table.assert_not_called()
+    
+    @patch('llm_service.supabase')
+    def test_available_foods_and_exercises_without_rpc(self, mock_db):
+        """Test the catalog falls back to table queries when the RPC is missing"""
+        mock_db.rpc().execute.side_effect = Exception("function active_catalog() does not exist")
+        mock_db.table().select().eq().execute.return_value = MagicMock(
+            data=[{"name": "Squats"}, {"name": "Salmon"}]
+        )
+        
+        foods, exercises = get_available_foods_and_exercises()
+        
+        assert foods == exercises == ("Salmon", "Squats")
+    
+    @patch('llm_service.get_available_foods_and_exercises',
+           return_value=(("Rice", "Salmon"), ("Plank", "Squats")))
+    def test_build_plan_messages_static_prefix(self, mock_items):
+        """Test the catalog sits in a shared system message and user constraints come last"""
+        first = _build_plan_messages(
+            "build muscle", ["peanuts"], [{"name": "knee injury", "severity": "mild"}]
+        )
+        second = _build_plan_messages("lose weight", [], [])
+        
+        assert [m["role"] for m in first] == ["system", "user"]
+        assert first[0] == second[0]
+        assert "Rice, Salmon" in first[0]["content"] and "Plank, Squats" in first[0]["content"]
+        assert '"build muscle"' in first[1]["content"]
+        assert "peanuts" in first[1]["content"]
+        assert "knee injury (mild)" in first[1]["content"]
+        assert len(first[0]["content"]) + len(first[1]["content"]) < 800
+        assert PLAN_SCHEMA["properties"]["meals"]["minItems"] == 4
+        assert PLAN_SCHEMA["properties"]["workouts"]["maxItems"] == 6
+    
+    def test_iter_plan_items_across_fragments(self):
+        """Test streamed objects are emitted once they close, even when split across chunks"""
+        fragments = ['```json\n{"meals": [{"name": "Oat', 's {x}", "calories": 1', '50}, {"name": "Salad"}],',
+                     ' "workouts": [{"name": "Push-Ups"}]}\n```']
+        result = list(_iter_plan_items(fragments))
+        assert result == [
+            ("meals", {"name": "Oats {x}", "calories": 150}),
+            ("meals", {"name": "Salad"}),
+            ("workouts", {"name": "Push-Ups"})
+        ]
+    
+    @patch('llm_service.get_available_foods_and_exercises', return_value=([], []))
     @patch('llm_service.client.chat.completions.create')
+    def test_stream_plan_from_llm_dedupes_and_defaults(self, mock_openai, mock_available):
+        """Test streamed plan items are deduplicated and get default values"""
+        content = json.dumps({
+            "meals": [{"name": "Chicken Salad", "calories": 350}],
+            "exercises": [{"name": "Push-Ups"}, {"name": "push-ups"}]
+        })
+        chunks = []
+        for i in range(0, len(content), 7):
+            chunk = Mock()
+            chunk.choices = [Mock()]
+            chunk.choices[0].delta.content = content[i:i + 7]
+            chunks.append(chunk)
+        mock_openai.return_value = iter(chunks)
+        
+        result = list(stream_plan_from_llm("build muscle", [], []))
+        
+        assert mock_openai.call_args.kwargs["stream"] is True
+        assert [section for section, _ in result] == ["meals", "workouts"]
+        assert result[0][1]["protein"] == 0
+        assert result[1][1]["duration"] == "30 minutes"
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
     @patch('llm_service.get_supabase_client')
-    def test_generate_plan_from_llm_success(self, mock_supabase, mock_openai):
+    async def test_generate_plan_from_llm_success(self, mock_supabase, mock_openai):
         """Test successful plan generation with valid LLM response"""
         # Mock database response
         mock_db = MagicMock()
@@ -52,8 +161,7 @@ class TestLLMService:
         mock_supabase.return_value = mock_db
         
         # Mock OpenAI response
-        mock_response = Mock()
-        mock_response.choices = [Mock()]
+        mock_response = _llm_response()
         mock_response.choices[0].message.content = json.dumps({
             "meals": [
                 {"name": "Chicken Salad", "calories": 350, "protein": 35, "carbs": 20, "fat": 12},
@@ -67,7 +175,7 @@ class TestLLMService:
         mock_openai.return_value = mock_response
         
         # Execute
-        result = generate_plan_from_llm(
+        result = await generate_plan_from_llm(
             goal="build muscle",
             allergies=["peanuts"],
             injuries=[{"name": "knee injury", "severity": "moderate"}]
@@ -80,10 +188,17 @@ class TestLLMService:
         assert len(result["workouts"]) == 2
         assert result["meals"][0]["name"] == "Chicken Salad"
         assert result["meals"][0]["calories"] == 350
+        
+        # Structured outputs requested with the strict plan schema
+        response_format = mock_openai.call_args.kwargs["response_format"]
+        assert response_format["type"] == "json_schema"
+        assert response_format["json_schema"]["strict"] is True
+        assert response_format["json_schema"]["schema"]["required"] == ["meals", "workouts"]
     
-    @patch('llm_service.client.chat.completions.create')
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
     @patch('llm_service.get_supabase_client')
-    def test_generate_plan_removes_duplicates(self, mock_supabase, mock_openai):
+    async def test_generate_plan_removes_duplicates(self, mock_supabase, mock_openai):
         """Test that duplicate meals/workouts are removed"""
         # Mock database
         mock_db = MagicMock()
@@ -91,8 +206,7 @@ class TestLLMService:
         mock_supabase.return_value = mock_db
         
         # Mock OpenAI response with duplicates
-        mock_response = Mock()
-        mock_response.choices = [Mock()]
+        mock_response = _llm_response()
         mock_response.choices[0].message.content = json.dumps({
             "meals": [
                 {"name": "Chicken Salad", "calories": 350, "protein": 35, "carbs": 20, "fat": 12},
@@ -108,7 +222,7 @@ class TestLLMService:
         mock_openai.return_value = mock_response
         
         # Execute
-        result = generate_plan_from_llm(
+        result = await generate_plan_from_llm(
             goal="lose weight",
             allergies=[],
             injuries=[]
@@ -124,9 +238,31 @@ class TestLLMService:
         assert len(meal_names) == len(set(meal_names))
         assert len(workout_names) == len(set(workout_names))
     
-    @patch('llm_service.client.chat.completions.create')
+    @pytest.mark.asyncio
+    @patch('llm_service.get_available_foods_and_exercises', return_value=([], []))
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_generate_plan_regenerate_skips_cached_plan(self, mock_openai, mock_available):
+        """Test a repeated request reuses the cached plan unless a new one is asked for"""
+        def plan_response(meal_name):
+            response = _llm_response()
+            response.choices[0].message.content = json.dumps({"meals": [{"name": meal_name}], "workouts": []})
+            return response
+        
+        mock_openai.side_effect = [plan_response("Oatmeal"), plan_response("Omelette")]
+        
+        first = await generate_plan_coalesced("build muscle", [], [])
+        repeated = await generate_plan_coalesced("build muscle", [], [])
+        regenerated = await generate_plan_coalesced("build muscle", [], [], regenerate=True)
+        after = await generate_plan_coalesced("build muscle", [], [])
+        
+        assert first["meals"][0]["name"] == repeated["meals"][0]["name"] == "Oatmeal"
+        assert regenerated["meals"][0]["name"] == after["meals"][0]["name"] == "Omelette"
+        assert mock_openai.call_count == 2
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
     @patch('llm_service.get_supabase_client')
-    def test_generate_plan_adds_default_values(self, mock_supabase, mock_openai):
+    async def test_generate_plan_adds_default_values(self, mock_supabase, mock_openai):
         """Test that missing nutritional values get defaults"""
         # Mock database
         mock_db = MagicMock()
@@ -134,8 +270,7 @@ class TestLLMService:
         mock_supabase.return_value = mock_db
         
         # Mock OpenAI response with missing values
-        mock_response = Mock()
-        mock_response.choices = [Mock()]
+        mock_response = _llm_response()
         mock_response.choices[0].message.content = json.dumps({
             "meals": [
                 {"name": "Chicken Salad", "calories": 350}  # Missing protein, carbs, fat
@@ -147,7 +282,7 @@ class TestLLMService:
         mock_openai.return_value = mock_response
         
         # Execute
-        result = generate_plan_from_llm(
+        result = await generate_plan_from_llm(
             goal="build muscle",
             allergies=[],
             injuries=[]
@@ -160,15 +295,35 @@ class TestLLMService:
         assert result["workouts"][0]["duration"] == "30 minutes"
         assert result["workouts"][0]["estimated_calories"] == 200
     
-    @patch('llm_service.client.chat.completions.create')
-    def test_validate_exercise_safety_returns_true(self, mock_openai):
+    @pytest.mark.asyncio
+    async def test_generate_plan_coalesced_shares_inflight_call(self):
+        """Test identical concurrent plan requests share one LLM call"""
+        plan = {"meals": [{"name": "Oats"}], "workouts": []}
+        
+        async def slow_generate(goal, allergies, injuries):
+            await asyncio.sleep(0.05)
+            return plan
+        
+        with patch('llm_service.generate_plan_from_llm', side_effect=slow_generate) as mock_generate:
+            results = await asyncio.gather(
+                generate_plan_coalesced("build muscle", ["Peanuts"], []),
+                generate_plan_coalesced("Build Muscle ", ["peanuts"], []),
+                generate_plan_coalesced("lose weight", [], []),
+            )
+        
+        assert mock_generate.call_count == 2
+        assert results[0] == results[1] == plan
+        assert results[0] is not results[1]  # each caller gets its own copy
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_validate_exercise_safety_returns_true(self, mock_openai):
         """Test exercise validation returns true for safe exercises"""
-        mock_response = Mock()
-        mock_response.choices = [Mock()]
-        mock_response.choices[0].message.content = "safe"
+        mock_response = _llm_response()
+        mock_response.choices[0].message.content = '{"results": {"Running": "safe"}}'
         mock_openai.return_value = mock_response
         
-        result = validate_exercise_safety(
+        result = await validate_exercise_safety(
             "Running",
             [{"name": "wrist pain", "severity": "mild"}],
             "lose weight"
@@ -176,15 +331,15 @@ class TestLLMService:
         
         assert result is True
     
-    @patch('llm_service.client.chat.completions.create')
-    def test_validate_exercise_safety_returns_false(self, mock_openai):
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_validate_exercise_safety_returns_false(self, mock_openai):
         """Test exercise validation returns false for unsafe exercises"""
-        mock_response = Mock()
-        mock_response.choices = [Mock()]
-        mock_response.choices[0].message.content = "unsafe"
+        mock_response = _llm_response()
+        mock_response.choices[0].message.content = '{"results": {"Squats": "unsafe"}}'
         mock_openai.return_value = mock_response
         
-        result = validate_exercise_safety(
+        result = await validate_exercise_safety(
             "Squats",
             [{"name": "knee injury", "severity": "severe"}],
             "build muscle"
@@ -192,11 +347,11 @@ class TestLLMService:
         
         assert result is False
     
-    @patch('llm_service.client.chat.completions.create')
-    def test_suggest_food_replacement(self, mock_openai):
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_suggest_food_replacement(self, mock_openai):
         """Test food replacement suggestion returns valid structure"""
-        mock_response = Mock()
-        mock_response.choices = [Mock()]
+        mock_response = _llm_response()
         mock_response.choices[0].message.content = json.dumps({
             "name": "Almond Milk Smoothie",
             "calories": 180,
@@ -206,7 +361,7 @@ class TestLLMService:
         })
         mock_openai.return_value = mock_response
         
-        result = suggest_food_replacement(
+        result = await suggest_food_replacement(
             "Greek Yogurt",
             "dairy",
             "lose weight"
@@ -218,11 +373,11 @@ class TestLLMService:
         assert "carbs" in result
         assert "fat" in result
     
-    @patch('llm_service.client.chat.completions.create')
-    def test_suggest_exercise_replacement(self, mock_openai):
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_suggest_exercise_replacement(self, mock_openai):
         """Test exercise replacement suggestion returns valid structure"""
-        mock_response = Mock()
-        mock_response.choices = [Mock()]
+        mock_response = _llm_response()
         mock_response.choices[0].message.content = json.dumps({
             "name": "Glute Bridge",
             "duration": "3 sets of 15",
@@ -230,7 +385,7 @@ class TestLLMService:
         })
         mock_openai.return_value = mock_response
         
-        result = suggest_exercise_replacement(
+        result = await suggest_exercise_replacement(
             "Squats",
             [{"name": "knee injury", "severity": "moderate"}],
             "build muscle"
@@ -240,9 +395,156 @@ class TestLLMService:
         assert result["duration"] == "3 sets of 15"
         assert result["estimated_calories"] == 90
     
-    @patch('llm_service.client.chat.completions.create')
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_suggest_exercise_replacement_shares_inflight_call(self, mock_openai):
+        """Test identical concurrent replacement requests share one LLM call"""
+        mock_response = _llm_response()
+        mock_response.choices[0].message.content = json.dumps({
+            "name": "Glute Bridge", "duration": "3 sets of 12", "estimated_calories": 90
+        })
+        
+        async def slow_create(**kwargs):
+            await asyncio.sleep(0.05)
+            return mock_response
+        mock_openai.side_effect = slow_create
+        
+        injuries = [{"name": "knee injury", "severity": "severe"}]
+        results = await asyncio.gather(
+            suggest_exercise_replacement("Squats", injuries, "build muscle"),
+            suggest_exercise_replacement("squats ", injuries, "Build Muscle"),
+        )
+        
+        assert mock_openai.call_count == 1
+        assert results[0] == results[1]
+        assert results[0] is not results[1]
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_validate_exercise_safety_cached_for_equivalent_input(self, mock_openai):
+        """Test repeated validations with equivalent (case/order-insensitive) input hit the cache"""
+        mock_response = _llm_response()
+        mock_response.choices[0].message.content = '{"results": {"Running": "safe"}}'
+        mock_openai.return_value = mock_response
+        
+        injuries = [{"name": "wrist pain", "severity": "mild"}, {"name": "knee", "severity": "severe"}]
+        first = await validate_exercise_safety("Running", injuries, "lose weight")
+        second = await validate_exercise_safety("  running ", list(reversed(injuries)), "Lose Weight")
+        
+        assert first is True and second is True
+        assert mock_openai.call_count == 1
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_validate_exercises_batch_single_call(self, mock_openai):
+        """Test several exercises are validated in one call; missing answers count as unsafe"""
+        mock_response = _llm_response()
+        mock_response.choices[0].message.content = json.dumps(
+            {"results": {"push-ups": "safe", "Squats": "unsafe"}}
+        )
+        mock_openai.return_value = mock_response
+        
+        result = await validate_exercises_batch(
+            ["Push-Ups", "Squats", "Plank"],
+            [{"name": "knee injury", "severity": "severe"}],
+            "build muscle"
+        )
+        
+        assert result == {"Push-Ups": True, "Squats": False, "Plank": False}
+        assert mock_openai.call_count == 1
+        assert mock_openai.call_args.kwargs["response_format"] == {"type": "json_object"}
+        assert mock_openai.call_args.kwargs["model"] == SAFETY_MODEL
+        assert mock_openai.call_args.kwargs["max_tokens"] == 16 + SAFETY_TOKENS_PER_EXERCISE * 3
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
+    async def test_suggest_food_replacement_errors_not_cached(self, mock_openai):
+        """Test fallback answers from failed LLM calls are not cached"""
+        mock_openai.side_effect = Exception("API Error")
+        await suggest_food_replacement("Greek Yogurt", "dairy", "lose weight")
+        await suggest_food_replacement("Greek Yogurt", "dairy", "lose weight")
+        
+        assert mock_openai.call_count == 2
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.get_available_foods_and_exercises', return_value=([], []))
+    @patch('llm_service.aclient')
+    async def test_submit_plan_batch_uploads_jsonl(self, mock_aclient, mock_available):
+        """Test batch submission uploads one chat-completion line per request"""
+        mock_aclient.files.create = AsyncMock(return_value=Mock(id="file-1"))
+        mock_aclient.batches.create = AsyncMock(return_value=Mock(id="batch-1", status="validating"))
+        requests = [
+            {"goal": "build muscle", "allergies": [], "injuries": []},
+            {"goal": "lose weight", "allergies": ["dairy"], "injuries": []}
+        ]
+        
+        result = await submit_plan_batch(requests, owner="user-123")
+        
+        assert result == {"batch_id": "batch-1", "status": "validating"}
+        _, jsonl = mock_aclient.files.create.call_args.kwargs["file"]
+        lines = [json.loads(line) for line in jsonl.decode("utf-8").splitlines()]
+        assert [line["custom_id"] for line in lines] == ["plan-0", "plan-1"]
+        assert lines[0]["url"] == "/v1/chat/completions"
+        batch_kwargs = mock_aclient.batches.create.call_args.kwargs
+        assert batch_kwargs["completion_window"] == "24h"
+        assert batch_kwargs["metadata"]["source"] == "plan-batch"
+        assert batch_kwargs["metadata"]["owner"] == "user-123"
+        assert json.loads(batch_kwargs["metadata"]["plan-1"])["allergies"] == ["dairy"]
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient')
+    async def test_get_plan_batch_results_orders_and_parses(self, mock_aclient):
+        """Test completed batch output is parsed and returned in submission order"""
+        def output_line(custom_id, content):
+            return json.dumps({
+                "custom_id": custom_id,
+                "response": {"body": {"choices": [{"message": {"content": content}}]}}
+            })
+        
+        mock_aclient.batches.retrieve = AsyncMock(return_value=Mock(
+            id="batch-1", status="completed", output_file_id="file-2",
+            metadata={"source": "plan-batch", "owner": "user-123", "plan-0": '{"goal":"a"}', "plan-1": '{"goal":"b"}'}
+        ))
+        mock_aclient.files.content = AsyncMock(return_value=Mock(text="\n".join([
+            output_line("plan-1", "not json"),
+            output_line("other-request", "{}"),
+            output_line("plan-7", "{}"),
+            output_line("plan-0", json.dumps({"meals": [{"name": "Eggs"}], "workouts": []}))
+        ])))
+        
+        result = await get_plan_batch_results("batch-1", owner="user-123")
+        
+        assert result["status"] == "completed"
+        assert [p["request"]["goal"] for p in result["plans"]] == ["a", "b"]
+        assert result["plans"][0]["plan"]["meals"][0]["calories"] == 0
+        assert "error" in result["plans"][1]["plan"]
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient')
+    async def test_get_plan_batch_results_ignores_foreign_and_unknown_batches(self, mock_aclient):
+        """Test batches not created by submit_plan_batch, another user's, or not found come back as None"""
+        mock_aclient.batches.retrieve = AsyncMock(return_value=Mock(
+            id="batch-2", status="completed", output_file_id="file-3", metadata={"job": "embeddings"}
+        ))
+        assert await get_plan_batch_results("batch-2", owner="user-123") is None
+        
+        mock_aclient.batches.retrieve = AsyncMock(return_value=Mock(
+            id="batch-3", status="completed", output_file_id="file-4",
+            metadata={"source": "plan-batch", "owner": "user-456", "plan-0": '{"goal":"a"}'}
+        ))
+        assert await get_plan_batch_results("batch-3", owner="user-123") is None
+        mock_aclient.files.content.assert_not_called()
+        
+        not_found = httpx.Response(404, request=httpx.Request("GET", "https://api.openai.com/v1/batches/nope"))
+        mock_aclient.batches.retrieve = AsyncMock(
+            side_effect=NotFoundError("No such batch", response=not_found, body=None)
+        )
+        assert await get_plan_batch_results("nope", owner="user-123") is None
+    
+    @pytest.mark.asyncio
+    @patch('llm_service.aclient.chat.completions.create', new_callable=AsyncMock)
     @patch('llm_service.get_supabase_client')
-    def test_generate_plan_handles_api_error(self, mock_supabase, mock_openai):
+    async def test_generate_plan_handles_api_error(self, mock_supabase, mock_openai):
         """Test graceful handling of OpenAI API errors"""
         # Mock database
         mock_db = MagicMock()
@@ -253,7 +555,7 @@ class TestLLMService:
         mock_openai.side_effect = Exception("API Error")
         
         # Execute
-        result = generate_plan_from_llm(
+        result = await generate_plan_from_llm(
             goal="build muscle",
             allergies=[],
             injuries=[]
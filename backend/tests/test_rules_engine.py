@@ -3,6 +3,7 @@
 Unit tests for Rules Engine (safety validation and substitution)
 Testing critical safety logic that prevents unsafe recommendations
 """
+import asyncio
 import pytest
 from unittest.mock import Mock, patch, MagicMock
 from rules_engine import RulesEngine
@@ -23,8 +24,8 @@ class TestRulesEngine:
     def test_check_food_has_allergen_database_match(self, rules_engine, mock_supabase):
         """Test allergen detection through database lookup"""
         # Mock database response with allergen
-        mock_supabase.table().select().ilike().limit().execute.return_value = MagicMock(
-            data=[{"allergens": ["dairy", "lactose"]}]
+        mock_supabase.table().select().execute.return_value = MagicMock(
+            data=[{"name": "Greek Yogurt", "allergens": ["dairy", "lactose"]}]
         )
         rules_engine.supabase = mock_supabase
         
@@ -39,8 +40,8 @@ class TestRulesEngine:
     def test_check_food_has_allergen_no_match(self, rules_engine, mock_supabase):
         """Test no allergen detection when food is safe"""
         # Mock database response without allergen
-        mock_supabase.table().select().ilike().limit().execute.return_value = MagicMock(
-            data=[{"allergens": ["gluten"]}]
+        mock_supabase.table().select().execute.return_value = MagicMock(
+            data=[{"name": "Chicken Breast", "allergens": ["gluten"]}]
         )
         rules_engine.supabase = mock_supabase
         
@@ -55,7 +56,7 @@ class TestRulesEngine:
     def test_check_food_has_allergen_fallback_name_matching(self, rules_engine, mock_supabase):
         """Test fallback to name-based matching when database has no entry"""
         # Mock empty database response
-        mock_supabase.table().select().ilike().limit().execute.return_value = MagicMock(
+        mock_supabase.table().select().execute.return_value = MagicMock(
             data=[]
         )
         rules_engine.supabase = mock_supabase
@@ -63,17 +64,48 @@ class TestRulesEngine:
         # Food name contains allergen
         has_allergen, allergen = rules_engine.check_food_has_allergen(
             "Peanut Butter Smoothie",
-            ["peanuts", "dairy"]
+            ["peanut", "dairy"]
         )
         
         assert has_allergen is True
-        assert allergen == "peanuts"
+        assert allergen == "peanut"
+    
+    def test_check_food_has_allergen_uses_prefetched_index(self, rules_engine, mock_supabase):
+        """Test checks against a prefetched allergen index don't query the database"""
+        rules_engine.supabase = mock_supabase
+        food_index = [("greek yogurt parfait", ["dairy"]), ("chicken breast", [])]
+        
+        results = [
+            rules_engine.check_food_has_allergen(name, ["dairy"], food_index)
+            for name in ["Greek Yogurt", "Chicken Breast"]
+        ]
+        
+        assert results == [(True, "dairy"), (False, None)]
+        mock_supabase.table.assert_not_called()
+    
+    def test_catalog_rows_cached_across_calls(self, rules_engine, mock_supabase):
+        """Test catalog queries are shared across calls and engines until invalidated"""
+        from rules_engine import invalidate_catalog_rows_cache
+        
+        mock_supabase.table().execute.return_value = MagicMock(data=[{"name": "Oats", "is_active": True}])
+        mock_supabase.table.reset_mock()
+        rules_engine.supabase = mock_supabase
+        other_engine = RulesEngine()
+        other_engine.supabase = mock_supabase
+        
+        assert rules_engine.get_food_items() == [{"name": "Oats", "is_active": True}]
+        assert other_engine.get_food_items() is rules_engine.get_food_items()  # Shared, not copied
+        assert mock_supabase.table.call_count == 1
+        
+        invalidate_catalog_rows_cache()
+        rules_engine.get_food_items()
+        assert mock_supabase.table.call_count == 2
     
     def test_check_exercise_has_contraindication_database_match(self, rules_engine, mock_supabase):
         """Test contraindication detection through database lookup"""
         # Mock database response with contraindication
-        mock_supabase.table().select().ilike().limit().execute.return_value = MagicMock(
-            data=[{"contraindications": ["knee injury", "knee pain"]}]
+        mock_supabase.table().select().execute.return_value = MagicMock(
+            data=[{"name": "Squats", "contraindications": ["knee injury", "knee pain"]}]
         )
         rules_engine.supabase = mock_supabase
         
@@ -88,8 +120,8 @@ class TestRulesEngine:
     def test_check_exercise_has_contraindication_no_match(self, rules_engine, mock_supabase):
         """Test no contraindication when exercise is safe"""
         # Mock database response without contraindication
-        mock_supabase.table().select().ilike().limit().execute.return_value = MagicMock(
-            data=[{"contraindications": ["shoulder injury"]}]
+        mock_supabase.table().select().execute.return_value = MagicMock(
+            data=[{"name": "Running", "contraindications": ["shoulder injury"]}]
         )
         rules_engine.supabase = mock_supabase
         
@@ -101,8 +133,36 @@ class TestRulesEngine:
         assert has_contra is False
         assert injury is None
     
+    def test_find_exercise_substitute_uses_prefetched_rules(self, rules_engine, mock_supabase):
+        """Test substitutes come from the highest-priority matching rule, then any safe exercise"""
+        rules_engine.supabase = mock_supabase
+        rules = [
+            {"contraindication": "shoulder pain", "exercise_items": {"name": "Walking"}},
+            {"contraindication": "knee injury", "exercise_items": {"name": "Swimming"}},
+            {"contraindication": "knee injury", "exercise_items": {"name": "Cycling"}},
+        ]
+        exercises = [{"name": "Lunges", "contraindications": ["wrist"]}]
+        
+        assert rules_engine.find_exercise_substitute("knee", rules, exercises)["name"] == "Swimming"
+        assert rules_engine.find_exercise_substitute("wrist", rules, exercises) is None
+        mock_supabase.table.assert_not_called()
+    
+    def test_find_food_substitute_uses_prefetched_rules(self, rules_engine, mock_supabase):
+        """Test food substitutes come from the highest-priority matching rule, then any safe food"""
+        rules_engine.supabase = mock_supabase
+        rules = [
+            {"allergen": "Dairy", "food_items": {"name": "Oat Milk"}},
+            {"allergen": "dairy", "food_items": {"name": "Soy Milk"}},
+        ]
+        foods = [{"name": "Peanut Butter", "allergens": ["peanuts"]}, {"name": "Rice", "allergens": []}]
+        
+        assert rules_engine.find_food_substitute("dairy", rules, foods)["name"] == "Oat Milk"
+        assert rules_engine.find_food_substitute("peanuts", rules, foods)["name"] == "Rice"
+        mock_supabase.table.assert_not_called()
+    
+    @pytest.mark.asyncio
     @patch('rules_engine.suggest_food_replacement')
-    def test_apply_allergy_rule_replaces_unsafe_meal(self, mock_suggest, rules_engine, mock_supabase):
+    async def test_apply_allergy_rule_replaces_unsafe_meal(self, mock_suggest, rules_engine, mock_supabase):
         """Test that unsafe meals are replaced with safe alternatives"""
         # Setup
         meals = [
@@ -112,14 +172,14 @@ class TestRulesEngine:
         allergies = ["dairy"]
         
         # Mock database - yogurt has dairy, chicken doesn't
-        def mock_db_response(*args, **kwargs):
-            if "Greek Yogurt" in str(args):
-                return MagicMock(data=[{"allergens": ["dairy", "lactose"]}])
-            else:
-                return MagicMock(data=[{"allergens": []}])
-        
-        mock_supabase.table().select().ilike().limit().execute.side_effect = mock_db_response
+        mock_supabase.table().select().execute.return_value = MagicMock(data=[
+            {"name": "Greek Yogurt", "allergens": ["dairy", "lactose"]},
+            {"name": "Chicken Salad", "allergens": []},
+        ])
         rules_engine.supabase = mock_supabase
+        # No substitution rules or other safe foods, so the LLM has to supply one
+        rules_engine.get_food_substitution_rules = Mock(return_value=[])
+        rules_engine.get_food_items = Mock(return_value=[])
         
         # Mock LLM replacement
         mock_suggest.return_value = {
@@ -131,7 +191,7 @@ class TestRulesEngine:
         }
         
         # Execute
-        safe_meals, replacements = rules_engine.apply_allergy_rule(
+        safe_meals, replacements = await rules_engine.apply_allergy_rule(
             meals, allergies, "lose weight"
         )
         
@@ -144,9 +204,10 @@ class TestRulesEngine:
         assert replacements[0]["with"] == "Almond Milk Smoothie"
         assert "dairy allergy" in replacements[0]["reason"]
     
-    @patch('rules_engine.validate_exercise_safety')
+    @pytest.mark.asyncio
+    @patch('rules_engine.validate_exercises_batch')
     @patch('rules_engine.suggest_exercise_replacement')
-    def test_apply_injury_rule_replaces_unsafe_workout(self, mock_suggest, mock_validate, rules_engine, mock_supabase):
+    async def test_apply_injury_rule_replaces_unsafe_workout(self, mock_suggest, mock_validate, rules_engine, mock_supabase):
         """Test that unsafe workouts are replaced with safe alternatives"""
         # Setup
         workouts = [
@@ -155,18 +216,17 @@ class TestRulesEngine:
         ]
         injuries = [{"name": "knee injury", "severity": "moderate"}]
         
-        # Mock database - squats have knee contraindication
-        def mock_db_response(*args, **kwargs):
-            if "Squats" in str(args):
-                return MagicMock(data=[{"contraindications": ["knee injury", "knee pain"]}])
-            else:
-                return MagicMock(data=[{"contraindications": []}])
-        
-        mock_supabase.table().select().ilike().limit().execute.side_effect = mock_db_response
+        # Mock database - squats have knee contraindication, no substitution rules
+        mock_supabase.table().select().execute.return_value = MagicMock(data=[
+            {"name": "Squats", "contraindications": ["knee injury", "knee pain"]},
+            {"name": "Push-Ups", "contraindications": []},
+        ])
+        mock_supabase.table().select().order().execute.return_value = MagicMock(data=[])
+        rules_engine.get_exercise_items = MagicMock(return_value=[])
         rules_engine.supabase = mock_supabase
         
         # Mock LLM validation and replacement
-        mock_validate.return_value = True  # Push-ups are safe
+        mock_validate.return_value = {"Push-Ups": True}  # Push-ups are safe
         mock_suggest.return_value = {
             "name": "Glute Bridge",
             "duration": "3 sets of 15",
@@ -174,7 +234,7 @@ class TestRulesEngine:
         }
         
         # Execute
-        safe_workouts, replacements = rules_engine.apply_injury_rule(
+        safe_workouts, replacements = await rules_engine.apply_injury_rule(
             workouts, injuries, "build muscle"
         )
         
@@ -186,9 +246,30 @@ class TestRulesEngine:
         assert replacements[0]["replaced"] == "Squats"
         assert replacements[0]["with"] == "Glute Bridge"
     
+    @pytest.mark.asyncio
+    async def test_apply_injury_rule_validates_workouts_in_one_call(self, rules_engine, mock_supabase):
+        """Test LLM safety checks for all unclear workouts are sent as a single batch"""
+        workouts = [{"name": n} for n in ["Running", "Rowing", "Plank"]]
+        injuries = [{"name": "wrist pain", "severity": "mild"}]
+        
+        # Empty database - every workout needs an LLM check
+        mock_supabase.table().select().execute.return_value = MagicMock(data=[])
+        rules_engine.supabase = mock_supabase
+        
+        with patch('rules_engine.validate_exercises_batch',
+                   return_value={"Running": True, "Rowing": True, "Plank": True}) as mock_validate:
+            safe_workouts, replacements = await rules_engine.apply_injury_rule(
+                workouts, injuries, "lose weight"
+            )
+        
+        assert [w["name"] for w in safe_workouts] == ["Running", "Rowing", "Plank"]
+        assert replacements == []
+        mock_validate.assert_called_once_with(["Running", "Rowing", "Plank"], injuries, "lose weight")
+    
+    @pytest.mark.asyncio
     @patch('rules_engine.suggest_exercise_replacement')
-    def test_apply_injury_rule_prevents_duplicate_replacements(self, mock_suggest, rules_engine, mock_supabase):
-        """Test that duplicate replacement names are retried"""
+    async def test_apply_injury_rule_prevents_duplicate_replacements(self, mock_suggest, rules_engine, mock_supabase):
+        """Test that substitutes come from the DB pool without duplicates, and the LLM only fills in once it runs out"""
         # Setup - two unsafe workouts
         workouts = [
             {"name": "Squats", "duration": "3 sets of 15", "estimated_calories": 120},
@@ -196,31 +277,36 @@ class TestRulesEngine:
         ]
         injuries = [{"name": "knee injury", "severity": "severe"}]
         
-        # Mock database - both have knee contraindication
-        mock_supabase.table().select().ilike().limit().execute.return_value = MagicMock(
-            data=[{"contraindications": ["knee injury"]}]
-        )
+        # Mock database - both have knee contraindication, one knee-safe exercise in the catalog
+        mock_supabase.table().select().execute.return_value = MagicMock(data=[
+            {"name": "Squats", "contraindications": ["knee injury"]},
+            {"name": "Lunges", "contraindications": ["knee injury"]},
+        ])
+        mock_supabase.table().select().order().execute.return_value = MagicMock(data=[])
+        rules_engine.get_exercise_items = MagicMock(return_value=[
+            {"name": "Squats", "contraindications": ["knee injury"]},
+            {"name": "Glute Bridge", "contraindications": []},
+        ])
         rules_engine.supabase = mock_supabase
         
-        # Mock LLM - first tries to return same replacement twice
+        # Mock LLM - only reached once the DB pool is used up
         mock_suggest.side_effect = [
-            {"name": "Glute Bridge", "duration": "3 sets of 15", "estimated_calories": 90},
-            {"name": "Glute Bridge", "duration": "3 sets of 12", "estimated_calories": 85},  # Duplicate!
-            {"name": "Hip Thrust", "duration": "3 sets of 12", "estimated_calories": 95}   # Different (retry success)
+            {"name": "Hip Thrust", "duration": "3 sets of 12", "estimated_calories": 95}
         ]
         
         # Execute
-        safe_workouts, replacements = rules_engine.apply_injury_rule(
+        safe_workouts, replacements = await rules_engine.apply_injury_rule(
             workouts, injuries, "build muscle"
         )
         
         # Verify no duplicates
         workout_names = [w["name"] for w in safe_workouts]
         assert len(workout_names) == len(set(workout_names))
-        assert "Glute Bridge" in workout_names
-        assert "Hip Thrust" in workout_names
+        assert workout_names == ["Glute Bridge", "Hip Thrust"]
+        assert mock_suggest.call_count == 1
     
-    def test_apply_injury_rule_severity_based_filtering(self, rules_engine, mock_supabase):
+    @pytest.mark.asyncio
+    async def test_apply_injury_rule_severity_based_filtering(self, rules_engine, mock_supabase):
         """Test that severity-based heuristic rules work correctly"""
         # Setup
         workouts = [
@@ -230,7 +316,7 @@ class TestRulesEngine:
         injuries = [{"name": "knee", "severity": "severe"}]  # SEVERE knee injury
         
         # Mock empty database (testing heuristic rules)
-        mock_supabase.table().select().ilike().limit().execute.return_value = MagicMock(
+        mock_supabase.table().select().execute.return_value = MagicMock(
             data=[]
         )
         rules_engine.supabase = mock_supabase
@@ -244,7 +330,7 @@ class TestRulesEngine:
             }
             
             # Execute
-            safe_workouts, replacements = rules_engine.apply_injury_rule(
+            safe_workouts, replacements = await rules_engine.apply_injury_rule(
                 workouts, injuries, "build muscle"
             )
             
@@ -254,9 +340,23 @@ class TestRulesEngine:
             assert "Leg Press" not in [w["name"] for w in safe_workouts]
             assert len(replacements) == 2
     
+    @pytest.mark.asyncio
+    async def test_apply_rules_without_restrictions_skips_checks(self, rules_engine, mock_supabase):
+        """Test a plan for a user with no allergies or injuries comes back unchanged without DB reads"""
+        rules_engine.supabase = mock_supabase
+        plan = {"meals": [{"name": "Oatmeal"}], "workouts": [{"name": "Squats"}]}
+        
+        result = await rules_engine.apply_rules(plan, "build muscle", [], [])
+        
+        assert result["meals"] == plan["meals"]
+        assert result["workouts"] == plan["workouts"]
+        assert result["replacements"] == {"meals": [], "workouts": []}
+        mock_supabase.table.assert_not_called()
+    
+    @pytest.mark.asyncio
     @patch('rules_engine.suggest_food_replacement')
     @patch('rules_engine.suggest_exercise_replacement')
-    def test_apply_rules_full_integration(self, mock_exercise_suggest, mock_food_suggest, rules_engine, mock_supabase):
+    async def test_apply_rules_full_integration(self, mock_exercise_suggest, mock_food_suggest, rules_engine, mock_supabase):
         """Test full rules engine integration (meals + workouts)"""
         # Setup plan with unsafe items
         plan = {
@@ -274,21 +374,23 @@ class TestRulesEngine:
         allergies = ["dairy", "peanuts"]
         injuries = [{"name": "knee injury", "severity": "moderate"}]
         
-        # Mock database responses
-        def mock_db_side_effect(*args, **kwargs):
-            query_str = str(args) if args else str(kwargs)
-            if "Greek Yogurt" in query_str or "yogurt" in query_str.lower():
-                return MagicMock(data=[{"allergens": ["dairy"]}])
-            elif "Peanut" in query_str or "peanut" in query_str.lower():
-                return MagicMock(data=[{"allergens": ["peanuts", "nuts"]}])
-            elif "Squats" in query_str or "squat" in query_str.lower():
-                return MagicMock(data=[{"contraindications": ["knee injury"]}])
-            else:
-                return MagicMock(data=[])
-        
-        mock_supabase.table().select().ilike().limit().execute.side_effect = mock_db_side_effect
-        mock_supabase.table().select().eq().execute.side_effect = mock_db_side_effect
+        # Mock database responses: allergen and contraindication indexes per table
+        tables = {"food_items": MagicMock(), "exercise_items": MagicMock()}
+        tables["food_items"].select().execute.return_value = MagicMock(data=[
+            {"name": "Greek Yogurt", "allergens": ["dairy"]},
+            {"name": "Peanut Butter Toast", "allergens": ["peanuts", "nuts"]},
+        ])
+        tables["exercise_items"].select().execute.return_value = MagicMock(data=[
+            {"name": "Squats", "contraindications": ["knee injury"]},
+            {"name": "Bench Press", "contraindications": []},
+        ])
+        mock_supabase.table.side_effect = tables.get
         rules_engine.supabase = mock_supabase
+        # No substitution rules or safe catalog items, so every replacement comes from the LLM
+        rules_engine.get_food_substitution_rules = Mock(return_value=[])
+        rules_engine.get_food_items = Mock(return_value=[])
+        rules_engine.get_exercise_substitution_rules = Mock(return_value=[])
+        rules_engine.get_exercise_items = Mock(return_value=[])
         
         # Mock LLM replacements
         mock_food_suggest.side_effect = [
@@ -301,10 +403,10 @@ class TestRulesEngine:
             "estimated_calories": 90
         }
         
-        # Mock validate_exercise_safety for bench press
-        with patch('rules_engine.validate_exercise_safety', return_value=True):
+        # Mock validate_exercises_batch for bench press
+        with patch('rules_engine.validate_exercises_batch', return_value={"Bench Press": True}):
             # Execute
-            result = rules_engine.apply_rules(plan, goal, allergies, injuries)
+            result = await rules_engine.apply_rules(plan, goal, allergies, injuries)
         
         # Verify
         assert len(result["meals"]) == 2
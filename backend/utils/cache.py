@@ -0,0 +1,78 @@
+# backend/utils/cache.py
+# Small in-process caches shared by the LLM, rules engine and API layers
+
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import orjson
+
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    Build a stable cache key from JSON-serializable parts.
+    Dict keys are sorted so equivalent inputs always hash the same.
+    """
+    payload = orjson.dumps(parts, option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.sha256(payload).hexdigest()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache with per-entry expiry.
+      - maxsize: least recently used entries are evicted past this size
+      - ttl: seconds an entry stays valid
+      - refresh_on_get: reset an entry's expiry every time it is read
+      - copy: deep-copy values in and out so callers can mutate what they get back;
+        turn off for large read-only values that every caller shares
+    """
+
+    def __init__(
+        self, maxsize: int = 256, ttl: float = 3600, refresh_on_get: bool = False, copy: bool = True
+    ) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh_on_get = refresh_on_get
+        self.copy = copy
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            now = time.monotonic()
+            if now >= expires_at:
+                del self._data[key]
+                return default
+
+            if self.refresh_on_get:
+                self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+
+        return copy.deepcopy(value) if self.copy else value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, copy.deepcopy(value) if self.copy else value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
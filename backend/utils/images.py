@@ -1,10 +1,24 @@
 # backend/utils/images.py
 # Smart image matching logic for food and exercise items
 
+from functools import lru_cache
+
+
 def get_smart_food_image(food_name: str) -> str:
     """Get appropriate food image using smart keyword matching"""
-    name_lower = food_name.lower()
-    
+    return _match_food_image(food_name.strip().lower())
+
+
+def get_smart_exercise_image(exercise_name: str) -> str:
+    """Get appropriate exercise image using smart keyword matching"""
+    return _match_exercise_image(exercise_name.strip().lower())
+
+
+# Matching is a pure function of the normalized name and the same names come up
+# across meals, plans and users, so results are memoized
+
+@lru_cache(maxsize=4096)
+def _match_food_image(name_lower: str) -> str:
     # Chicken/Turkey
     if any(word in name_lower for word in ['chicken', 'turkey']):
         return 'https://images.pexels.com/photos/2338407/pexels-photo-2338407.jpeg?auto=compress&cs=tinysrgb&w=800'
@@ -57,10 +71,8 @@ def get_smart_food_image(food_name: str) -> str:
     return 'https://images.pexels.com/photos/1640777/pexels-photo-1640777.jpeg?auto=compress&cs=tinysrgb&w=800'
 
 
-def get_smart_exercise_image(exercise_name: str) -> str:
-    """Get appropriate exercise image using smart keyword matching"""
-    name_lower = exercise_name.lower()
-    
+@lru_cache(maxsize=4096)
+def _match_exercise_image(name_lower: str) -> str:
     # Bench Press
     if any(word in name_lower for word in ['bench press', 'chest press', 'incline press', 'decline press']):
         return 'https://images.pexels.com/photos/3837757/pexels-photo-3837757.jpeg?auto=compress&cs=tinysrgb&w=800'
@@ -0,0 +1,34 @@
+# backend/utils/singleflight.py
+# Coalesce concurrent identical async calls into one in-flight task
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    While a call for a key is running, later callers with the same key
+    await that call instead of starting their own.
+    The shared work runs as its own task, so a caller that disconnects
+    (is cancelled) doesn't cancel it for the others.
+    Completed results are not kept - pair with a cache for that.
+    """
+
+    def __init__(self) -> None:
+        self._inflight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: "asyncio.Future[Any]") -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    def __len__(self) -> int:
+        return len(self._inflight)
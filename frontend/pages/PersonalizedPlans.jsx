@@ -4,7 +4,12 @@ import { useNavigate } from "react-router-dom";
 import Navbar from "../src/components/Navbar.jsx";
 import WorkoutCard from "../src/components/WorkoutCard.jsx";
 import MealCard from "../src/components/MealCard.jsx";
-import { generatePlan } from "../src/api.js";
+import { generatePlanStream } from "../src/api.js";
+
+const WORKOUT_FALLBACK_IMAGE =
+  "https://images.pexels.com/photos/1552103/pexels-photo-1552103.jpeg?auto=compress&cs=tinysrgb&w=800";
+const MEAL_FALLBACK_IMAGE =
+  "https://images.pexels.com/photos/1640777/pexels-photo-1640777.jpeg?auto=compress&cs=tinysrgb&w=800";
 
 export default function PersonalizedPlans() {
   const navigate = useNavigate();
@@ -55,38 +60,54 @@ export default function PersonalizedPlans() {
     };
   }, [workouts.length, meals.length]);
 
-  // Helper function to fetch food image from database
-  async function fetchFoodImage(foodName) {
-    try {
-      const response = await fetch(
-        `http://localhost:8000/api/food-image?name=${encodeURIComponent(foodName)}`,
-        { credentials: "include" }
-      );
-      if (response.ok) {
-        const data = await response.json();
-        return data.image_url;
-      }
-    } catch (err) {
-      console.error("Error fetching food image:", err);
-    }
-    return "https://images.pexels.com/photos/1640777/pexels-photo-1640777.jpeg?auto=compress&cs=tinysrgb&w=800";
+  // Helpers to turn a streamed workout/meal into the card shape the page renders
+  function toWorkoutCard(w, index, image) {
+    return {
+      id: index + 1,
+      title: w.name,
+      category: "Workout",
+      level: "Intermediate",
+      duration: w.duration || "30 min",
+      calories: w.estimated_calories || 200,
+      image,
+      focus: w.category || "Full body",
+      equipment: ["Equipment varies"],
+      description: `AI-generated workout for: ${goal}`,
+      tutorialUrl: "https://youtube.com/",
+    };
+  }
+
+  function toMealCard(m, index, image) {
+    return {
+      id: index + 1,
+      title: m.name,
+      category: "Meal",
+      timeOfDay: index === 0 ? "Breakfast" : index === 1 ? "Lunch" : "Dinner",
+      calories: m.calories || 400,
+      protein: m.protein || 0,
+      carbs: m.carbs || 0,
+      fat: m.fat || 0,
+      image,
+    };
   }
 
-  // Helper function to fetch exercise image from database
-  async function fetchExerciseImage(exerciseName) {
+  // Helper function to fetch images for many items from the database in one request
+  async function fetchImages(kind, names, fallbackUrl) {
     try {
-      const response = await fetch(
-        `http://localhost:8000/api/exercise-image?name=${encodeURIComponent(exerciseName)}`,
-        { credentials: "include" }
-      );
+      const response = await fetch(`http://localhost:8000/api/${kind}-images`, {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        credentials: "include",
+        body: JSON.stringify({ names }),
+      });
       if (response.ok) {
         const data = await response.json();
-        return data.image_url;
+        return names.map((name) => data.image_urls[name] || fallbackUrl);
       }
     } catch (err) {
-      console.error("Error fetching exercise image:", err);
+      console.error(`Error fetching ${kind} images:`, err);
     }
-    return "https://images.pexels.com/photos/1552103/pexels-photo-1552103.jpeg?auto=compress&cs=tinysrgb&w=800";
+    return names.map(() => fallbackUrl);
   }
 
   // Logout handler
@@ -121,66 +142,79 @@ export default function PersonalizedPlans() {
         .map(i => i.trim())
         .filter(i => i.length > 0);
 
-      // Call the backend API
+      // Call the backend API, rendering meals/workouts as they stream in
       console.log("Sending request:", { goal, allergies: allergyList, injuries: injuryList });
-      
-      const result = await generatePlan({
-        goal: goal,
-        allergies: allergyList,
-        injuries: injuryList,
-      });
 
-      console.log("Plan generated:", result);
+      const streamedWorkouts = [];
+      const streamedMeals = [];
+      let result = null;
+      // The plan view needs at least one workout and one meal to show
+      const showPlanOnceStarted = () => {
+        if (streamedWorkouts.length > 0 && streamedMeals.length > 0) setShowForm(false);
+      };
+
+      // Start from fresh, empty lists for this plan
+      setWorkouts([]);
+      setMeals([]);
+      setSelectedWorkout(null);
+      setSelectedMeal(null);
+      setReplacements(null);
+
+      await generatePlanStream(
+        {
+          goal: goal,
+          allergies: allergyList,
+          injuries: injuryList,
+        },
+        (event, data) => {
+          if (event === "workout") {
+            const workout = toWorkoutCard(data, streamedWorkouts.length, WORKOUT_FALLBACK_IMAGE);
+            streamedWorkouts.push(workout);
+            setWorkouts([...streamedWorkouts]);
+            setSelectedWorkout((current) => current || workout);
+            showPlanOnceStarted();
+          } else if (event === "meal") {
+            const meal = toMealCard(data, streamedMeals.length, MEAL_FALLBACK_IMAGE);
+            streamedMeals.push(meal);
+            setMeals([...streamedMeals]);
+            setSelectedMeal((current) => current || meal);
+            showPlanOnceStarted();
+          } else if (event === "done") {
+            result = data;
+          } else if (event === "error") {
+            throw new Error(data.detail || "Failed to generate plan");
+          }
+        }
+      );
 
-      // Update state with the generated plan
-      if (result.safe_plan) {
-        // Fetch images for workouts from database
-        const generatedWorkouts = await Promise.all(
-          result.safe_plan.workouts.map(async (w, index) => {
-            const imageUrl = await fetchExerciseImage(w.name);
-            return {
-              id: index + 1,
-              title: w.name,
-              category: "Workout",
-              level: "Intermediate",
-              duration: w.duration || "30 min",
-              calories: w.estimated_calories || 200,
-              image: imageUrl,
-              focus: w.category || "Full body",
-              equipment: ["Equipment varies"],
-              description: `AI-generated workout for: ${goal}`,
-              tutorialUrl: "https://youtube.com/",
-            };
-          })
-        );
-
-        // Fetch images for meals from database
-        const generatedMeals = await Promise.all(
-          result.safe_plan.meals.map(async (m, index) => {
-            const imageUrl = await fetchFoodImage(m.name);
-            return {
-              id: index + 1,
-              title: m.name,
-              category: "Meal",
-              timeOfDay: index === 0 ? "Breakfast" : index === 1 ? "Lunch" : "Dinner",
-              calories: m.calories || 400,
-              protein: m.protein || 0,
-              carbs: m.carbs || 0,
-              fat: m.fat || 0,
-              image: imageUrl,
-            };
-          })
-        );
-
-        setWorkouts(generatedWorkouts);
-        setMeals(generatedMeals);
-        setSelectedWorkout(generatedWorkouts[0]);
-        setSelectedMeal(generatedMeals[0]);
-        setReplacements(result.replacements_made);
-        setShowForm(false);
+      if (!result) {
+        throw new Error("Plan stream ended before the plan was complete");
       }
+
+      console.log("Plan generated:", result);
+      setReplacements(result.replacements_made);
+
+      // Swap in images from the database once every item is known
+      const [workoutImages, mealImages] = await Promise.all([
+        fetchImages("exercise", streamedWorkouts.map((w) => w.title), WORKOUT_FALLBACK_IMAGE),
+        fetchImages("food", streamedMeals.map((m) => m.title), MEAL_FALLBACK_IMAGE),
+      ]);
+
+      const generatedWorkouts = streamedWorkouts.map((w, index) => ({ ...w, image: workoutImages[index] }));
+      const generatedMeals = streamedMeals.map((m, index) => ({ ...m, image: mealImages[index] }));
+
+      setWorkouts(generatedWorkouts);
+      setMeals(generatedMeals);
+      setSelectedWorkout((current) => generatedWorkouts.find((w) => w.id === current?.id) || generatedWorkouts[0] || null);
+      setSelectedMeal((current) => generatedMeals.find((m) => m.id === current?.id) || generatedMeals[0] || null);
     } catch (err) {
       console.error("Error generating plan:", err);
+      // Drop a half-streamed plan and go back to the form, where the error is shown
+      setWorkouts([]);
+      setMeals([]);
+      setSelectedWorkout(null);
+      setSelectedMeal(null);
+      setShowForm(true);
       setError(err.message || "Failed to generate plan. Make sure the backend is running on port 8000.");
     } finally {
       setLoading(false);
@@ -552,7 +586,7 @@ export default function PersonalizedPlans() {
                   <div className="border-t pt-4">
                     <button
                       onClick={handleSavePlan}
-                      disabled={savingPlan}
+                      disabled={savingPlan || loading}
                       className="w-full rounded-lg bg-green-600 px-4 py-3 font-medium text-white hover:bg-green-700 disabled:opacity-50 transition-colors flex items-center justify-center gap-2"
                     >
                       {savingPlan ? (
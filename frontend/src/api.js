@@ -29,7 +29,50 @@ export async function generatePlan(userData) {
   return handleResponse(response);
 }
 
+/**
+ * Generate a plan and stream it as Server-Sent Events.
+ * Calls onEvent(event, data) for each `meal`, `workout`, `done` or `error` frame
+ * so meals/workouts can be rendered as soon as they arrive.
+ */
+export async function generatePlanStream(userData, onEvent) {
+  const response = await fetch(`${API_BASE_URL}/generate-plan/stream`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify(userData),
+  });
+
+  if (!response.ok) {
+    await handleResponse(response);
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+
+    buffer += decoder.decode(value, { stream: true });
+    const frames = buffer.split('\n\n');
+    buffer = frames.pop();
+
+    for (const frame of frames) {
+      let event = 'message';
+      let data = '';
+      for (const line of frame.split('\n')) {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      }
+      if (data) onEvent(event, JSON.parse(data));
+    }
+  }
+}
+
 // Export other functions...
 export default {
   generatePlan,
+  generatePlanStream,
 };
\ No newline at end of file